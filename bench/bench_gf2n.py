@@ -0,0 +1,109 @@
+## bench_gf2n.py - micro benchmarks for gf2n.py.
+##
+## Usage: python3 ./bench/bench_gf2n.py
+##
+## Compares gf2pow128mul() with the generic gf2n_mul() and with the batch
+## API, using the GF(2^128) vectors from tests/test_gf2n.py.
+
+import os
+import sys
+import random
+import timeit
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, '../src'))
+sys.path.insert(0, os.path.join(here, '../tests'))
+
+import gf2n
+from gf2n import *
+from test_gf2n import gf2pow128mul_vectors
+
+def report(label, seconds, count):
+    print(f'{label:<40} {seconds * 1e6 / count:10.3f} us/op')
+
+def bench(label, func, count, number=3):
+    seconds = min(timeit.repeat(func, number=1, repeat=number))
+    report(label, seconds, count)
+    return seconds
+
+def bench_batch(batch):
+    """Multiply every test vector operand a by the whole batch."""
+    count = len(gf2pow128mul_vectors) * len(batch)
+    print(f'--- {len(gf2pow128mul_vectors)} fixed operands x {len(batch)} values')
+    base = bench('gf2pow128mul() scalar loop',
+                 lambda: [[gf2pow128mul(a, b) for b in batch] for a, _, _ in gf2pow128mul_vectors], count)
+    fast = bench('gf2pow128mul_many() list',
+                 lambda: [gf2pow128mul_many(a, batch) for a, _, _ in gf2pow128mul_vectors], count)
+    print(f'{"speedup":<40} {base / fast:10.1f}x')
+    if numpy is not None:
+        words = numpy.array([(b >> 64, b & 0xffffffffffffffff) for b in batch], dtype=numpy.uint64)
+        fast = bench('gf2pow128mul_many() numpy array',
+                     lambda: [gf2pow128mul_many(a, words) for a, _, _ in gf2pow128mul_vectors], count)
+        print(f'{"speedup":<40} {base / fast:10.1f}x')
+
+def bench_scalar():
+    """The dedicated GF(2^128) multiply and reduce against the generic gf2n_mul()."""
+    vectors = [(a, b) for a, b, _ in gf2pow128mul_vectors]
+    vectors += [(b, a) for a, b in vectors]  # the full width operand first as well
+    print(f'--- {len(vectors)} scalar products')
+    base = bench('gf2n_mul(a, b, mod128)',
+                 lambda: [gf2n_mul(a, b, mod128) for a, b in vectors], len(vectors))
+    fast = bench('gf2pow128mul()',
+                 lambda: [gf2pow128mul(a, b) for a, b in vectors], len(vectors))
+    print(f'{"speedup":<40} {base / fast:10.1f}x')
+
+def bench_gf2n_mul_engines():
+    """gf2n_mul() with the per-bit loop against the bit spreading engine."""
+    vectors = [(a, b) for a, b, _ in gf2pow128mul_vectors]
+    print(f'--- gf2n_mul() engines, {len(vectors)} products')
+    spread_min_bits = gf2n.gf2n_mul_spread_min_bits
+    gf2n.gf2n_mul_spread_min_bits = 1 << 30
+    base = bench('gf2n_mul() per-bit loop',
+                 lambda: [gf2n_mul(a, b, mod128) for a, b in vectors], len(vectors))
+    gf2n.gf2n_mul_spread_min_bits = spread_min_bits
+    fast = bench('gf2n_mul() bit spreading',
+                 lambda: [gf2n_mul(a, b, mod128) for a, b in vectors], len(vectors))
+    print(f'{"speedup":<40} {base / fast:10.1f}x')
+
+def bench_field():
+    """GF2nField log/antilog tables against gf2n_mul() in the AES field GF(2^8)."""
+    random.seed(1)
+    pairs = [(random.randrange(256), random.randrange(1, 256)) for _ in range(2048)]
+    field = GF2nField(0x11b)
+    print(f'--- GF(2^8), {len(pairs)} products')
+    base = bench('gf2n_mul(a, b, 0x11b)',
+                 lambda: [gf2n_mul(a, b, 0x11b) for a, b in pairs], len(pairs))
+    fast = bench('GF2nField(0x11b).mul()',
+                 lambda: [field.mul(a, b) for a, b in pairs], len(pairs))
+    print(f'{"speedup":<40} {base / fast:10.1f}x')
+
+    def inverse(b):
+        # b^254 by square and multiply with gf2n_mul()
+        res, k = 1, 254
+        while k:
+            if k & 1:
+                res = gf2n_mul(res, b, 0x11b)
+            b = gf2n_mul(b, b, 0x11b)
+            k >>= 1
+        return res
+    print(f'--- GF(2^8), {len(pairs)} inverses')
+    base = bench('square and multiply with gf2n_mul()',
+                 lambda: [inverse(b) for _, b in pairs], len(pairs))
+    fast = bench('GF2nField(0x11b).inverse()',
+                 lambda: [field.inverse(b) for _, b in pairs], len(pairs))
+    print(f'{"speedup":<40} {base / fast:10.1f}x')
+
+def main():
+    random.seed(0)
+    for a, b, expected in gf2pow128mul_vectors:
+        assert gf2pow128mul_many(a, [b]) == [expected]
+    bench_gf2n_mul_engines()
+    bench_field()
+    bench_scalar()
+    bench_batch([b for _, b, _ in gf2pow128mul_vectors])
+    bench_batch([random.getrandbits(128) for _ in range(4096)])
+    if numpy is None:
+        print('numpy is not installed, skipped the vectorized path')
+
+if __name__ == '__main__':
+    main()
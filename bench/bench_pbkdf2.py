@@ -0,0 +1,67 @@
+## bench_pbkdf2.py - micro benchmarks for keystrengthening.py.
+##
+## Usage: python3 ./bench/bench_pbkdf2.py
+##
+## Reports PBKDF2 iterations per second for each TrueCrypt hash: the pure
+## Python loop with the former per-byte xor_string() chain, the current
+## int accumulated chain, and PBKDF2() itself, which may use hashlib.
+
+import os
+import sys
+import struct
+import timeit
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, '../src'))
+
+import keystrengthening
+from keystrengthening import *
+
+ITERATIONS = 2000
+DERIVEDLEN = 128 # one TrueCrypt header keypool
+
+def report(label, seconds, iterations):
+    print(f'{label:<40} {iterations / seconds:12.0f} iterations/s')
+
+def bench(label, func, iterations, number=3):
+    seconds = min(timeit.repeat(func, number=1, repeat=number))
+    report(label, seconds, iterations)
+    return seconds
+
+def PBKDF2_xor_string(hmacfunc, password, salt, iterations, derivedlen):
+    """The pure Python PBKDF2 with the former xor_string() chain, for comparison."""
+    prf = HMACKey(*HMAC_HASHES[hmacfunc], password).digest
+    hLen = len(prf(b''))
+    tmp = bytearray()
+    i = 1
+    while len(tmp) < derivedlen:
+        U_prev = prf(salt + struct.pack('>L', i))
+        res = bytearray(U_prev)
+        for cc in range(2, iterations + 1):
+            U_c = bytearray(prf(U_prev))
+            res = xor_string(res, U_c)
+            U_prev = U_c
+        tmp += res
+        i += 1
+    return bytes(tmp[:derivedlen])
+
+def main():
+    password, salt = b'password', os.urandom(64)
+    for hmacfunc, name in [(HMAC_SHA1, 'SHA-1'), (HMAC_RIPEMD160, 'RIPEMD-160'), (HMAC_WHIRLPOOL, 'Whirlpool')]:
+        expected = PBKDF2_python(hmacfunc, password, salt, 5, DERIVEDLEN)
+        assert PBKDF2_xor_string(hmacfunc, password, salt, 5, DERIVEDLEN) == expected
+        blocks = -(-DERIVEDLEN // len(hmacfunc(b'', b'')))
+        iterations = ITERATIONS * blocks
+        print(f'--- {name}, {ITERATIONS} iterations x {blocks} blocks')
+        base = bench('xor_string() chain',
+                     lambda: PBKDF2_xor_string(hmacfunc, password, salt, ITERATIONS, DERIVEDLEN), iterations)
+        fast = bench('PBKDF2_python() int chain',
+                     lambda: PBKDF2_python(hmacfunc, password, salt, ITERATIONS, DERIVEDLEN), iterations)
+        print(f'{"speedup":<40} {base / fast:10.1f}x')
+        if hmacfunc in keystrengthening.PBKDF2_HASHLIB:
+            fast = bench('PBKDF2() hashlib.pbkdf2_hmac()',
+                         lambda: PBKDF2(hmacfunc, password, salt, ITERATIONS, DERIVEDLEN), iterations)
+            print(f'{"speedup":<40} {base / fast:10.1f}x')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,211 @@
+## backends.py - Registry of the cipher implementations.
+##
+## Information
+## ===========
+##
+## Each cipher algorithm is registered under its class name with
+## register_cipher(), and each of its implementations ("backends", e.g.
+## the one block, lane-packed and NumPy Serpent engines) with register().
+## The cipher classes ask select() which backend to use for a call of a
+## given number of blocks.
+##
+## The choice comes from, in order:
+##   1. an override, "Serpent=lanes,Twofish=package", from the
+##      PYTRUECRYPT_BACKENDS environment variable or set_overrides(),
+##   2. a calibration run timing every available backend at a few batch
+##      sizes on first use of an algorithm. It is cached in the JSON file
+##      PYTRUECRYPT_BACKENDS_CACHE, by default backends.json in the user's
+##      cache directory, and redone when the Python version, machine or
+##      set of available backends changes,
+##   3. the min_blocks thresholds given to register(), if
+##      PYTRUECRYPT_BACKENDS_CACHE is set to the empty string. Register the
+##      preferred backend first, it wins ties.
+
+import os
+import sys
+import json
+import bisect
+import platform
+import functools
+import timeit
+
+BACKENDS_ENV = 'PYTRUECRYPT_BACKENDS'
+BACKENDS_CACHE_ENV = 'PYTRUECRYPT_BACKENDS_CACHE'
+CALIBRATION_BLOCKS = (1, 2, 4, 8, 16, 32, 128, 512, 2048, 4096, 16384) # batch sizes timed by calibrate()
+CALIBRATION_MAX_SECONDS = 0.1 # backends expected to take longer for a batch are not timed
+
+class Backend:
+    """
+    One implementation of an algorithm. crypt_into(cipher, direction, dst, src)
+    encrypts or decrypts (direction 'encrypt' or 'decrypt') the blocks in src
+    into dst for cipher, a keyed instance of the algorithm's class.
+    """
+    def __init__(self, name, crypt_into, available, min_blocks):
+        self.name = name
+        self.crypt_into = crypt_into
+        self.available = available
+        self.min_blocks = min_blocks
+
+    def __repr__(self):
+        return f'<Backend {self.name}>'
+
+_ciphers = {} # algorithm -> (cipher class, key size)
+_backends = {} # algorithm -> {name: Backend}
+_plans = {} # algorithm -> (batch sizes, backend names) of plan()
+_overrides = {} # algorithm -> backend name, from set_overrides()
+
+def register_cipher(algorithm, cipher, key_size):
+    _ciphers[algorithm] = (cipher, key_size)
+    _backends.setdefault(algorithm, {})
+
+def register(algorithm, name, crypt_into, available=lambda: True, min_blocks=1):
+    """
+    Register a backend. available() tells whether it can run here and
+    min_blocks is the smallest call it is used for without calibration.
+    """
+    _backends.setdefault(algorithm, {})[name] = Backend(name, crypt_into, available, min_blocks)
+    _plans.pop(algorithm, None)
+
+def cipher(algorithm):
+    """The cipher class registered for algorithm."""
+    if algorithm not in _ciphers:
+        raise KeyError(f'unknown cipher {algorithm}')
+    return _ciphers[algorithm][0]
+
+def get(algorithm, name):
+    return _backends[algorithm][name]
+
+def available(algorithm):
+    """Names of the backends of algorithm that can run here."""
+    return [name for name, backend in _backends[algorithm].items() if backend.available()]
+
+def parse_overrides(spec):
+    """Parse "Serpent=lanes,Twofish=package" into a dict."""
+    overrides = {}
+    for item in filter(None, (item.strip() for item in spec.split(','))):
+        algorithm, sep, name = item.partition('=')
+        if not sep:
+            raise ValueError(f'backend override {item!r} is not of the form cipher=backend')
+        overrides[algorithm.strip()] = name.strip()
+    return overrides
+
+def check_overrides(spec):
+    """Parse spec like parse_overrides() and check that the backends exist and are available."""
+    overrides = parse_overrides(spec)
+    for algorithm, name in overrides.items():
+        if algorithm not in _backends:
+            raise ValueError(f'unknown cipher {algorithm}, choose from {sorted(_backends)}')
+        if name not in available(algorithm):
+            raise ValueError(f'{algorithm} backend {name!r} is not available, choose from {available(algorithm)}')
+    return overrides
+
+def set_overrides(spec):
+    """Force backends, e.g. from a command line flag. Takes precedence over the environment."""
+    overrides = check_overrides(spec)
+    _overrides.clear()
+    _overrides.update(overrides)
+
+@functools.lru_cache(maxsize=4)
+def _env_overrides(spec):
+    return parse_overrides(spec)
+
+def _override(algorithm):
+    name = _overrides.get(algorithm) or _env_overrides(os.environ.get(BACKENDS_ENV, '')).get(algorithm)
+    if name is None:
+        return None
+    if name not in _backends[algorithm] or not _backends[algorithm][name].available():
+        raise ValueError(f'{algorithm} backend {name!r} is not available, choose from {available(algorithm)}')
+    return _backends[algorithm][name]
+
+def select(algorithm, num_blocks):
+    """The backend to use for num_blocks blocks of algorithm."""
+    backend = _override(algorithm)
+    if backend is not None:
+        return backend
+    if algorithm not in _plans:
+        _plans[algorithm] = tuple(zip(*plan(algorithm)))
+    sizes, names = _plans[algorithm]
+    return _backends[algorithm][names[max(bisect.bisect_right(sizes, num_blocks) - 1, 0)]]
+
+#
+# Calibration.
+#
+
+def cache_path():
+    """The calibration cache file, or None if calibration is turned off."""
+    path = os.environ.get(BACKENDS_CACHE_ENV)
+    if path is not None:
+        return path or None
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_home, 'pytruecrypt', 'backends.json')
+
+def _fingerprint(algorithm):
+    return f'{sys.version_info[0]}.{sys.version_info[1]} {platform.machine()} {sorted(available(algorithm))}'
+
+def _load_cache(path):
+    try:
+        with open(path) as fileobj:
+            cache = json.load(fileobj)
+    except (OSError, ValueError):
+        return {}
+    return cache if isinstance(cache, dict) else {}
+
+def _save_cache(path, cache):
+    try:
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path, 'w') as fileobj:
+            json.dump(cache, fileobj, indent=1, sort_keys=True)
+    except OSError:
+        pass # no writable cache, calibrate again next time
+
+def static_plan(algorithm):
+    """
+    The plan from the registered min_blocks thresholds. Of backends with
+    the same threshold the first registered one is used.
+    """
+    thresholds = {}
+    for name in available(algorithm):
+        thresholds.setdefault(_backends[algorithm][name].min_blocks, name)
+    return sorted(thresholds.items())
+
+def calibrate(algorithm):
+    """
+    Time every available backend at each of CALIBRATION_BLOCKS and return
+    the plan [(num_blocks, fastest backend name), ...]. A backend is not
+    timed at a size where it would take more than CALIBRATION_MAX_SECONDS,
+    extrapolating linearly from the previous size.
+    """
+    names = available(algorithm)
+    if len(names) == 1:
+        return [(1, names[0])]
+    cipher_class, key_size = _ciphers[algorithm]
+    instance = cipher_class(bytes(range(key_size)))
+    last = {} # name -> (num_blocks, seconds) of the last timing
+    result = []
+    for num_blocks in CALIBRATION_BLOCKS:
+        buf = bytearray(16 * num_blocks)
+        timings = []
+        for name in names:
+            if name in last and last[name][1] * num_blocks / last[name][0] > CALIBRATION_MAX_SECONDS:
+                continue
+            crypt_into = _backends[algorithm][name].crypt_into
+            seconds = min(timeit.repeat(lambda: crypt_into(instance, 'decrypt', buf, buf), number=1, repeat=2))
+            last[name] = num_blocks, seconds
+            timings.append((seconds, name))
+        if timings:
+            result.append((num_blocks, min(timings)[1]))
+    return result
+
+def plan(algorithm):
+    """The [(num_blocks, backend name), ...] plan of algorithm, calibrated or cached."""
+    path = cache_path()
+    if path is None:
+        return static_plan(algorithm)
+    cache = _load_cache(path)
+    entry = cache.get(algorithm)
+    fingerprint = _fingerprint(algorithm)
+    if not isinstance(entry, dict) or entry.get('fingerprint') != fingerprint or not entry.get('plan'):
+        entry = {'fingerprint': fingerprint, 'plan': calibrate(algorithm)}
+        cache[algorithm] = entry
+        _save_cache(path, cache)
+    return sorted((num_blocks, name) for num_blocks, name in entry['plan'])
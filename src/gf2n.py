@@ -22,6 +22,14 @@
 ## FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
 ## OTHER DEALINGS IN THE SOFTWARE.
 
+import functools
+
+try:
+    import numpy
+except ImportError:
+    # NumPy is optional; without it only the pure Python code paths are available.
+    numpy = None
+
 mod128 = 0x100000000000000000000000000000087 # x^128+x^7+x^2+x+1
 
 # A detailed explanation of how this works can be found at
@@ -40,6 +48,43 @@ mod128 = 0x100000000000000000000000000000087 # x^128+x^7+x^2+x+1
 # This modulo step can be performed with simple long division but by
 # binary OR:ing instead of subtracting.
 
+# Carry-less multiplication by bit spreading.
+# Python's big int multiplication runs in C (with Karatsuba for large
+# operands). If every bit of a and b is moved into its own byte, a normal
+# integer product of the spread values has, in byte k, the number of pairs
+# of set bits a_i, b_j with i + j = k. That count is smaller than 256 as long
+# as the shorter operand has fewer than 256 bits, so no carry leaks into the
+# next byte, and its lowest bit is exactly bit k of the carry-less product.
+# Spreading and collecting are done with bytes.translate() on the binary
+# string of the operands so no per-bit Python loop is left at all. Wider
+# operands use two bytes per bit, produced by encoding the binary string
+# as UTF-16.
+
+_clmul_spread_digits = bytes.maketrans(b'01', b'\x00\x01')
+_clmul_parity_digits = bytes(ord('0') + (v & 1) for v in range(256))
+
+# Operand widths, in bits of the shorter operand, from which clmul_spread()
+# is used instead of the Python loops. Measured with CPython 3.11: the
+# generic loop in gf2n_mul() is overtaken from about 8 bits, the 4-bit
+# window in gf2pow128mul() only for (nearly) full width operands.
+gf2n_mul_spread_min_bits = 8
+gf2pow128mul_spread_min_bits = 120
+
+def clmul_spread(a, b):
+    """Carry-less multiplication of a and b by bit spreading."""
+    if not a or not b:
+        return 0
+    if min(a.bit_length(), b.bit_length()) < 256:
+        A = int.from_bytes(bin(a)[2:].encode('ascii').translate(_clmul_spread_digits), 'big')
+        B = int.from_bytes(bin(b)[2:].encode('ascii').translate(_clmul_spread_digits), 'big')
+        c = (A * B).to_bytes(a.bit_length() + b.bit_length() - 1, 'big')
+    else:
+        # the low byte of each 16 bit slot holds the parity we are after
+        A = int.from_bytes(bin(a)[2:].encode('utf-16-be').translate(_clmul_spread_digits), 'big')
+        B = int.from_bytes(bin(b)[2:].encode('utf-16-be').translate(_clmul_spread_digits), 'big')
+        c = (A * B).to_bytes(2 * (a.bit_length() + b.bit_length() - 1), 'big')[1::2]
+    return int(c.translate(_clmul_parity_digits), 2)
+
 def gf2n_mul(a, b, mod):
     """
     Multiplication in GF(2^n).
@@ -91,6 +136,10 @@ def gf2n_mul(a, b, mod):
             n ^= (mod << x)  # Reduce n by XORing with mod shifted left by x
         return n        
 
+    # For wide operands the bit spreading engine is faster than the loop below.
+    if min(a.bit_length(), b.bit_length()) >= gf2n_mul_spread_min_bits:
+        return xor_mod(clmul_spread(a, b), mod)
+
     # Precompute the terms of b by creating a list of powers of 2
     # corresponding to the set bits in b
     b_terms = [1 << i for i in range(b.bit_length()) if b & (1 << i)]
@@ -106,8 +155,249 @@ def gf2n_mul(a, b, mod):
         
     return xor_mod(res, mod)  # Reduce the result modulo mod using XOR
 
+mask128 = (1 << 128) - 1
+
+def gf2pow128reduce(n):
+    """
+    Reduce a product of two GF(2^128) elements (below 2^255) modulo mod128.
+
+    As x^128 = x^7 + x^2 + x + 1 the bits above x^127 fold back in at
+    shifts 0, 1, 2 and 7. The first fold leaves at most 6 bits above x^127
+    (from the shift by 7) and the second fold leaves none, so unlike the
+    generic xor_mod() loop in gf2n_mul() there is no bit_length() test and
+    no shifting of the whole modulus.
+    """
+    hi = n >> 128
+    n = (n & mask128) ^ hi ^ (hi << 1) ^ (hi << 2) ^ (hi << 7)
+    hi = n >> 128
+    return (n & mask128) ^ hi ^ (hi << 1) ^ (hi << 2) ^ (hi << 7)
+
 def gf2pow128mul(a, b):
-    return gf2n_mul(a, b, mod128)
+    """
+    Multiplication in GF(2^128) modulo x^128+x^7+x^2+x+1.
+
+    Dedicated version of gf2n_mul(a, b, mod128). The carry-less product
+    comes from clmul_spread() for full width operands, otherwise it is built 4 bits
+    of the shorter operand at a time from the 16 multiples of the other
+    operand. Either way it is then reduced with gf2pow128reduce().
+    """
+    if a.bit_length() > b.bit_length():
+        a, b = b, a
+    if a.bit_length() >= gf2pow128mul_spread_min_bits:
+        return gf2pow128reduce(clmul_spread(a, b))
+    b2 = b << 1
+    b4 = b << 2
+    b8 = b << 3
+    b3 = b2 ^ b
+    b12 = b8 ^ b4
+    table = (0, b, b2, b3, b4, b4 ^ b, b4 ^ b2, b4 ^ b3,
+             b8, b8 ^ b, b8 ^ b2, b8 ^ b3, b12, b12 ^ b, b12 ^ b2, b12 ^ b3)
+    res = 0
+    for shift in range(((a.bit_length() + 3) & ~3) - 4, -4, -4):
+        res = (res << 4) ^ table[(a >> shift) & 0xf]
+    return gf2pow128reduce(res)
+
+def gf2pow128mulx(a):
+    """Multiplication by x in GF(2^128)."""
+    a <<= 1
+    if a >> 128:
+        a ^= mod128
+    return a
+
+class GF128Multiplier:
+    """
+    Multiplication by a fixed element h of GF(2^128).
+
+    Shoup's table method. When one operand is fixed, as the LRW key K2 is
+    for the life of a volume, the products h * (b << 8j) can be precomputed
+    for every byte value b and every byte position j. Multiplying h by any
+    x is then the XOR of one table entry per byte of x, with no per-bit
+    loop and no reduction step. Building the 16 tables of 256 entries costs
+    about as much as a few hundred gf2pow128mul() calls, so it pays off as
+    soon as the same h is used for a sector or two.
+    """
+
+    def __init__(self, h: int):
+        self.h = h
+        self.tables = []
+        hx = h  # h * x^(8j) for the current byte position j
+        for j in range(16):
+            table = [0] * 256
+            for k in range(8):
+                table[1 << k] = hx
+                hx = gf2pow128mulx(hx)
+            # Multiplication distributes over addition (XOR), so every other
+            # entry is the sum of the entry for its lowest set bit and the rest.
+            for b in range(3, 256):
+                low = b & -b
+                if b != low:
+                    table[b] = table[low] ^ table[b ^ low]
+            self.tables.append(table)
+        self._array_tables = None  # NumPy copy of the tables, built by mul_array()
+
+    def mul(self, x: int) -> int:
+        """Return h * x in GF(2^128). x must be smaller than 2^128."""
+        res = 0
+        for table in self.tables:
+            if not x:
+                break  # the remaining bytes of x are zero, e.g. small LRW indices
+            res ^= table[x & 0xff]
+            x >>= 8
+        return res
+
+    def mul_many(self, values) -> list:
+        """Return [h * x for x in values]. Pure Python table path."""
+        tables = self.tables
+        out = []
+        for x in values:
+            res = 0
+            for table in tables:
+                if not x:
+                    break
+                res ^= table[x & 0xff]
+                x >>= 8
+            out.append(res)
+        return out
+
+    def mul_array(self, values):
+        """
+        Vectorized NumPy path. values is a uint64 array, either of shape (N,)
+        for operands below 2^64 or (N, 2) holding the (high, low) words of
+        128 bit operands. Returns h * x for every operand as an (N, 2) uint64
+        array of (high, low) words. Each of the 16 byte positions is one table
+        gather for all N operands.
+        """
+        if numpy is None:
+            raise ImportError('GF128Multiplier.mul_array() requires numpy')
+        if self._array_tables is None:
+            words = [[(v >> 64, v & 0xffffffffffffffff) for v in table] for table in self.tables]
+            self._array_tables = numpy.array(words, dtype=numpy.uint64)  # shape (16, 256, 2)
+        values = numpy.asarray(values, dtype=numpy.uint64)
+        if values.ndim == 1:
+            words = (values,)
+        else:
+            words = (values[:, 1], values[:, 0])  # low word first, as the tables are ordered
+        res = numpy.zeros((len(values), 2), dtype=numpy.uint64)
+        for w, word in enumerate(words):
+            for j in range(8):
+                byte = ((word >> numpy.uint64(8 * j)) & numpy.uint64(0xff)).astype(numpy.intp)
+                res ^= self._array_tables[8 * w + j][byte]
+        return res
+
+# Batch size from which gf2pow128mul_many() builds the GF128Multiplier
+# tables for a list of values. Measured with CPython 3.11: building the
+# tables takes about as long as 100 to 150 gf2pow128mul() calls.
+gf2pow128mul_many_min_values = 128
+
+@functools.lru_cache(maxsize=8)
+def _gf128_multiplier(a: int) -> GF128Multiplier:
+    return GF128Multiplier(a)
+
+def gf2pow128mul_many(a, values):
+    """
+    Multiply the fixed element a by every element of values in GF(2^128).
+
+    values may be a sequence of ints, which returns a list, or a NumPy uint64
+    array as accepted by GF128Multiplier.mul_array(), which returns an (N, 2)
+    array. Batches shorter than gf2pow128mul_many_min_values use
+    gf2pow128mul(), longer ones the GF128Multiplier tables for a, which are
+    cached for the last few a.
+    """
+    if numpy is not None and isinstance(values, numpy.ndarray):
+        if len(values) >= gf2pow128mul_many_min_values:
+            return _gf128_multiplier(a).mul_array(values)
+        if values.ndim == 1:
+            values = [int(b) for b in values]
+        else:
+            values = [(int(hi) << 64) | int(lo) for hi, lo in values]
+        words = [(x >> 64, x & 0xffffffffffffffff) for x in (gf2pow128mul(a, b) for b in values)]
+        return numpy.array(words, dtype=numpy.uint64).reshape(len(words), 2)
+    if len(values) < gf2pow128mul_many_min_values:
+        return [gf2pow128mul(a, b) for b in values]
+    return _gf128_multiplier(a).mul_many(values)
+
+def gf2_polymod(n, mod):
+    """Remainder of the polynomial n divided by the polynomial mod, both over GF(2)."""
+    while n.bit_length() >= mod.bit_length():
+        n ^= mod << (n.bit_length() - mod.bit_length())
+    return n
+
+class GF2nField:
+    """
+    GF(2^n) for small n (up to GF2nField.max_bits) using log/antilog tables.
+
+    Every non-zero element of the field is a power of a generator g, so
+    a * b = g^(log a + log b). With exp[] and log[] tabulated, multiply,
+    divide, inverse and power are one or two table lookups each. The
+    tables for n = 16 hold 2^16 entries so they are built once per
+    modulus and shared by every GF2nField for it. mod must be irreducible,
+    e.g. 0x11b for the AES field GF(2^8).
+    """
+
+    max_bits = 16
+    _tables = {}  # mod -> (generator, exp, log)
+
+    def __init__(self, mod: int):
+        self.mod = mod
+        self.n = mod.bit_length() - 1
+        self.order = (1 << self.n) - 1  # size of the multiplicative group
+        if not 1 <= self.n <= self.max_bits:
+            raise ValueError(f'GF2nField supports GF(2^1) to GF(2^{self.max_bits}), not GF(2^{self.n})')
+        if mod not in self._tables:
+            self._tables[mod] = self._build_tables()
+        self.generator, self.exp, self.log = self._tables[mod]
+
+    def _build_tables(self):
+        mod, n, order = self.mod, self.n, self.order
+        # Irreducible means no factor of degree 1 to n / 2.
+        for d in range(2, 1 << (n // 2 + 1)):
+            if gf2_polymod(mod, d) == 0:
+                raise ValueError(f'{hex(mod)} is not irreducible so GF(2^{n}) cannot be built with it')
+        # The powers of g run through all non-zero elements only if g is a generator.
+        for g in range(2, 1 << n):
+            exp = [0] * (2 * order)  # doubled so exp[log a + log b] needs no modulo
+            log = [0] * (1 << n)
+            g_bits = [i for i in range(g.bit_length()) if (g >> i) & 1]
+            x = 1
+            for k in range(order):
+                if k and x == 1:
+                    break  # g has a smaller order, try the next candidate
+                exp[k] = exp[k + order] = x
+                log[x] = k
+                gx = 0
+                for i in g_bits:
+                    gx ^= x << i
+                x = gf2_polymod(gx, mod)
+            else:
+                return g, exp, log
+        # GF(2) itself, 1 is the only non-zero element
+        return 1, [1, 1], [0, 0]
+
+    def mul(self, a: int, b: int) -> int:
+        """Multiplication in GF(2^n)."""
+        if not a or not b:
+            return 0
+        return self.exp[self.log[a] + self.log[b]]
+
+    def div(self, a: int, b: int) -> int:
+        """Division in GF(2^n)."""
+        if not b:
+            raise ZeroDivisionError('division by zero in GF(2^n)')
+        if not a:
+            return 0
+        return self.exp[self.log[a] + self.order - self.log[b]]
+
+    def inverse(self, a: int) -> int:
+        """Multiplicative inverse in GF(2^n)."""
+        return self.div(1, a)
+
+    def power(self, a: int, k: int) -> int:
+        """a raised to the integer power k in GF(2^n)."""
+        if not a:
+            if k < 0:
+                raise ZeroDivisionError('zero has no inverse in GF(2^n)')
+            return 0 if k else 1
+        return self.exp[(self.log[a] * k) % self.order]
 
 # Add and subtract polynomials modulo 2. See explanation above why this
 # code is so simple.
@@ -25,6 +25,8 @@
 
 import struct
 import math
+import hashlib
+import functools
 
 from hashlib import sha1
 from Crypto.Hash import RIPEMD160
@@ -54,20 +56,52 @@ def hexdigest(S):
 trans_5C = bytes((x ^ 0x5C) for x in range(256))
 trans_36 = bytes((x ^ 0x36) for x in range(256))
 
+class HMACKey:
+    """
+    HMAC with a fixed key. The padded key is absorbed into the inner and
+    outer hash states once, and each message starts from .copy() of them,
+    which saves the two key blocks and the key preparation per message.
+
+    Fallback: if the hash objects cannot be copied (no .copy() method, or
+    it raises), each message starts from fresh hash objects fed the
+    precomputed padded keys, i.e. the cost of plain HMAC() minus the key
+    preparation.
+    """
+    def __init__(self, hash_func, hash_block_size, key):
+        # Code taken from the cpython hmac.py class: https://t.ly/f6KZY
+        # revision: 39cd9728a6770d8fe7937c57385cda5c2e25a223
+        inner = hash_func()
+        outer = hash_func()
+        blocksize = getattr(inner, 'block_size', hash_block_size)
+        if len(key) > blocksize:
+            key = hash_func(key).digest()
+        key = key + b'\x00' * (blocksize - len(key))
+        self.hash_func = hash_func
+        self.inner_key = key.translate(trans_36)
+        self.outer_key = key.translate(trans_5C)
+        inner.update(self.inner_key)
+        outer.update(self.outer_key)
+        self.inner = inner
+        self.outer = outer
+        try:
+            inner.copy()
+            self.copyable = True
+        except (AttributeError, NotImplementedError, TypeError, ValueError):
+            self.copyable = False
+
+    def digest(self, message):
+        if self.copyable:
+            inner = self.inner.copy()
+            outer = self.outer.copy()
+        else:
+            inner = self.hash_func(self.inner_key)
+            outer = self.hash_func(self.outer_key)
+        inner.update(message)
+        outer.update(inner.digest())
+        return outer.digest()
+
 def HMAC(hash_func, hash_block_size, key, message):
-    # Code taken from the cpython hmac.py class: https://t.ly/f6KZY
-    # revision: 39cd9728a6770d8fe7937c57385cda5c2e25a223
-    inner = hash_func()
-    outer = hash_func()
-    blocksize = getattr(inner, 'block_size', hash_block_size)
-    if len(key) > blocksize:
-        key = hash_func(key).digest()
-    key = key + b'\x00' * (blocksize - len(key))
-    inner.update(key.translate(trans_36))
-    outer.update(key.translate(trans_5C))
-    inner.update(message)
-    outer.update(inner.digest())
-    return outer.digest()
+    return HMACKey(hash_func, hash_block_size, key).digest(message)
 
 def HMAC_SHA1(key, message):
     return HMAC(HASH_SHA1, 64, key, message)
@@ -78,6 +112,13 @@ def HMAC_RIPEMD160(key, message):
 def HMAC_WHIRLPOOL(key, message):
     return HMAC(HASH_WHIRLPOOL, 64, key, message)
 
+# The hash and block size of each HMAC func, so PBKDF2 can key an HMACKey once.
+HMAC_HASHES = {
+    HMAC_SHA1: (HASH_SHA1, 64),
+    HMAC_RIPEMD160: (HASH_RIPEMD160, 64),
+    HMAC_WHIRLPOOL: (HASH_WHIRLPOOL, 64),
+}
+
 #
 # PBKDF2.
 # http://www.ietf.org/rfc/rfc2898.txt
@@ -91,31 +132,141 @@ def xor_string(a: bytearray, b: bytearray) -> bytearray:
         result[i] = a[i] ^ b[i]  # Perform XOR for each byte
     return result
 
-def PBKDF2(hmacfunc, password, salt, iterations, derivedlen):
-    """Derive keys using the PBKDF2 key strengthening algorithm."""
-    # Note that Python hashlib.pbkdf2_hmac() supports sha1 but does not support ripeme160 or whirlpool
+def _PRF(hmacfunc, password):
+    if hmacfunc in HMAC_HASHES:
+        # The password is the HMAC key of every iteration, so prepare it once.
+        return HMACKey(*HMAC_HASHES[hmacfunc], password).digest
+    return lambda message: hmacfunc(password, message)
+
+def PBKDF2_block(hmacfunc, password, salt, iterations, i):
+    """
+    The PBKDF2 output block T_i. The blocks are independent of each other,
+    and this is a module level function so it can be sent to a process pool.
+    """
+    prf = _PRF(hmacfunc, password)
+    # T_i = U_1 ^ U_2 ^ ... ^ U_c, accumulated as an int so each
+    # iteration is one int XOR instead of a loop over the bytes
+    U = prf(salt + struct.pack('>L', i))
+    T = int.from_bytes(U, 'big')
+    for cc in range(2, iterations + 1):
+        U = prf(U)
+        T ^= int.from_bytes(U, 'big')
+    return T.to_bytes(len(U), 'big')
+
+def PBKDF2_python(hmacfunc, password, salt, iterations, derivedlen, executor=None):
+    """
+    Derive keys using the PBKDF2 key strengthening algorithm, in pure Python.
+    With executor, a concurrent.futures executor, the output blocks are
+    computed concurrently; use a process pool to spread them over the cores.
+    """
     # Note that hashcat has some GPU code for pbkdf2 with sha1 but not ripeme160 or whirlpool
     hLen = len(hmacfunc(b'', b''))  # Digest size
     l = int(math.ceil(derivedlen / float(hLen)))  # Number of blocks needed
-    r = derivedlen - (l - 1) * hLen  # Remaining bytes in the last block
-    def F(P, S, c, i):
-        U_prev = hmacfunc(P, S + struct.pack('>L', i))
-        res = bytearray(U_prev)  # Pre-allocate a bytearray for the result
-        for cc in range(2, c+1):
-            U_c = bytearray(hmacfunc(P, U_prev))
-            res = xor_string(res, U_c)
-            U_prev = U_c
-        return res
-    # Pre-allocate a bytearray for the final derived key with the total size
-    tmp = bytearray(l * hLen)
-    i = 1
-    offset = 0  # Offset to track where to write in tmp
-    while True:
-        block = F(password, salt, iterations, i)
-        tmp[offset:offset + len(block)] = block  # Fill the pre-allocated bytearray
-        offset += len(block)  # Update the offset
-        if offset >= derivedlen:
-            break
-        i += 1
-
-    return bytes(tmp[:derivedlen])  # Return the derived key as bytes
+    block = functools.partial(PBKDF2_block, hmacfunc, password, salt, iterations)
+    if executor is None or l == 1:
+        blocks = map(block, range(1, l + 1))
+    else:
+        blocks = executor.map(block, range(1, l + 1))
+    return b''.join(blocks)[:derivedlen]
+
+# hashlib.pbkdf2_hmac() names of the HMAC funcs. It always has sha1, and
+# ripemd160 and whirlpool when the local OpenSSL provides them.
+PBKDF2_HASHLIB_NAMES = {
+    HMAC_SHA1: 'sha1',
+    HMAC_RIPEMD160: 'ripemd160',
+    HMAC_WHIRLPOOL: 'whirlpool',
+}
+
+def _hashlib_pbkdf2_matches(hmacfunc, name):
+    """Whether hashlib.pbkdf2_hmac() runs for name and agrees with PBKDF2_python()."""
+    password, salt = b'password', b'\x12\x34\x56\x78'
+    try:
+        native = hashlib.pbkdf2_hmac(name, password, salt, 5, 68)
+    except ValueError:
+        return False # unsupported by this OpenSSL
+    return native == PBKDF2_python(hmacfunc, password, salt, 5, 68)
+
+# Checked once at import, the HMAC funcs that PBKDF2() hands to hashlib.
+PBKDF2_HASHLIB = {hmacfunc: name for hmacfunc, name in PBKDF2_HASHLIB_NAMES.items()
+                  if _hashlib_pbkdf2_matches(hmacfunc, name)}
+
+def PBKDF2(hmacfunc, password, salt, iterations, derivedlen, executor=None):
+    """
+    Derive keys using the PBKDF2 key strengthening algorithm. Uses the C
+    implementation hashlib.pbkdf2_hmac() for the hashes in PBKDF2_HASHLIB
+    and PBKDF2_python() for the others, which is given executor. hashlib
+    computes the blocks one after the other, but faster than a process
+    pool could hand them out, so executor is not used for it.
+    """
+    name = PBKDF2_HASHLIB.get(hmacfunc)
+    if name is not None:
+        return hashlib.pbkdf2_hmac(name, password, salt, iterations, derivedlen)
+    return PBKDF2_python(hmacfunc, password, salt, iterations, derivedlen, executor)
+
+class PBKDF2Keypool:
+    """
+    The derivedlen bytes of PBKDF2() output, derived only as byte ranges of
+    it are first requested: keypool[32:64] derives the blocks covering bytes
+    32 to 63, once. bytes(keypool) is the whole output.
+
+    Without an executor the pure Python hashes derive exactly the missing
+    blocks. With one they derive all blocks in one concurrent batch on the
+    first request, as a round per request would add the latency of a block
+    each time. hashlib.pbkdf2_hmac() can only derive blocks 1 to
+    k at once and a later block would mean deriving them all again, which
+    would make a failed trial of every key cost 11 blocks instead of 7 with
+    SHA-1. The hashes in PBKDF2_HASHLIB therefore derive the whole output
+    on the first request. The password is dropped once every block is
+    derived.
+    """
+    def __init__(self, hmacfunc, password, salt, iterations, derivedlen, executor=None):
+        self.hmacfunc = hmacfunc
+        self.password = password
+        self.salt = salt
+        self.iterations = iterations
+        self.derivedlen = derivedlen
+        self.executor = executor
+        self.hLen = len(hmacfunc(b'', b''))  # Digest size
+        self.blocks = {}  # i -> T_i
+
+    def __len__(self):
+        return self.derivedlen
+
+    def __bytes__(self):
+        return self[0:self.derivedlen]
+
+    def __getitem__(self, key):
+        if not isinstance(key, slice): raise TypeError('keypool indices must be slices')
+        start, stop, step = key.indices(self.derivedlen)
+        if step != 1: raise ValueError('keypool slices must be contiguous')
+        if stop <= start:
+            return b''
+        first, last = start // self.hLen + 1, (stop - 1) // self.hLen + 1
+        self.derive(range(first, last + 1))
+        data = b''.join(self.blocks[i] for i in range(first, last + 1))
+        offset = (first - 1) * self.hLen
+        return data[start - offset:stop - offset]
+
+    def derive(self, indices):
+        """
+        Derive the blocks T_i for i in indices that are not derived yet, or
+        all of them if any is missing and the keypool has an executor.
+        """
+        missing = [i for i in indices if i not in self.blocks]
+        if not missing:
+            return
+        last = (self.derivedlen - 1) // self.hLen + 1
+        name = PBKDF2_HASHLIB.get(self.hmacfunc)
+        if name is not None:
+            data = hashlib.pbkdf2_hmac(name, self.password, self.salt, self.iterations, last * self.hLen)
+            for i in range(1, last + 1):
+                self.blocks[i] = data[(i - 1) * self.hLen:i * self.hLen]
+        else:
+            block = functools.partial(PBKDF2_block, self.hmacfunc, self.password, self.salt, self.iterations)
+            if self.executor is None:
+                self.blocks.update(zip(missing, map(block, missing)))
+            else:
+                missing = [i for i in range(1, last + 1) if i not in self.blocks]
+                self.blocks.update(zip(missing, self.executor.map(block, missing)))
+        if len(self.blocks) == last:
+            self.password = None # nothing left to derive
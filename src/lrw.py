@@ -23,11 +23,20 @@
 ## OTHER DEALINGS IN THE SOFTWARE.
 
 import sys
+import functools
 
 # TODO consider replacing with galois package for performance
 from gf2n import *
 
+try:
+    import numpy
+except ImportError:
+    # NumPy is optional; without it the pure Python code paths are used.
+    numpy = None
+
 LRW_blocksize = 16
+# Runs of at least this many blocks use the NumPy code paths when available.
+LRW_numpy_min_blocks = 64
 
 def str2int(str: bytes) -> int:
     # TODO assertions must observe sys.byteorder
@@ -60,26 +69,272 @@ def xorstring16(a: bytes, b: bytes) -> bytes:
         result[i] = a[i] ^ b[i]  # Perform XOR for each byte
     return bytes(result)
 
+@functools.lru_cache(maxsize=32)
+def _lrw_multiplier(lrwkey: bytes) -> GF128Multiplier:
+    return GF128Multiplier(str2int(lrwkey))
+
+def lrw_multiplier(lrwkey, cached=True) -> GF128Multiplier:
+    """
+    Returns the GF128Multiplier for the LRW key K2.
+    The tables are built once per key and cached, so callers can keep
+    passing the raw 16 byte key. With cached=False they are built for the
+    caller only and no copy of the key is kept. A GF128Multiplier is
+    returned as-is.
+    """
+    if isinstance(lrwkey, GF128Multiplier):
+        return lrwkey
+    if False is (LRW_blocksize == len(lrwkey)): raise AssertionError(f'lrwkey size must be {LRW_blocksize}')
+    if not cached:
+        return GF128Multiplier(str2int(lrwkey))
+    return _lrw_multiplier(bytes(lrwkey))
+
 # C_i = E_K1(P_i ^ (K2 x i)) ^ (K2 x i).
 # Note that cipherfunc = E_K1, that is the key should already be set in E.
-# lrwkey = K2.
+# lrwkey = K2, either the raw 16 bytes or the lrw_multiplier() for them.
 def LRW(cipherfunc, lrwkey, i, block) -> bytes:
     """Perform an LRW operation."""
     if False is (LRW_blocksize == len(block)): raise AssertionError(f'block size must be {LRW_blocksize}')
-    if False is (LRW_blocksize == len(lrwkey)): raise AssertionError(f'lrwkey size must be {LRW_blocksize}')
-    K2 = str2int(lrwkey)
+    K2 = lrw_multiplier(lrwkey)
     # C_i = E_K1(P_i ^ K2i) ^ K2i
-    K2i = int2str(gf2pow128mul(K2, i))
+    K2i = int2str(K2.mul(i))
     # zero byte pad to LRW_blocksize bytes
     K2i = b'\x00' * (LRW_blocksize - len(K2i)) + K2i
     if False is (LRW_blocksize == len(K2i)): raise AssertionError(f'K2i size must be {LRW_blocksize}')
     return xorstring16(K2i, cipherfunc(xorstring16(K2i, block)))
 
+@functools.lru_cache(maxsize=8)
+def _block_ones(n: int) -> int:
+    """n blocks each holding the value 1; multiplying by it repeats a 16 byte value n times."""
+    return int.from_bytes((b'\x00' * (LRW_blocksize - 1) + b'\x01') * n, 'big')
+
+class _LRWTweakTables:
+    """Everything about the tweaks that depends only on the LRW key K2."""
+
+    def __init__(self, K2: GF128Multiplier):
+        self.K2 = K2
+        self.steps = [K2.mul((2 << t) - 1) for t in range(128)]  # steps[t] = K2 x (2^(t + 1) - 1)
+        self.patterns = {}  # m -> K2 x 0 ... K2 x (2^m - 1) as one integer
+        self.pattern_arrays = {}  # m -> the same as a NumPy array
+
+    def tweaks(self, i, count):
+        """
+        Yields the tweaks K2 x i, K2 x (i + 1), ... K2 x (i + count - 1).
+
+        Multiplication by K2 is linear over GF(2), so
+        K2 x (i + 1) = (K2 x i) ^ (K2 x (i ^ (i + 1))). i ^ (i + 1) is always
+        2^(t + 1) - 1 where t is the number of trailing one bits in i, so after
+        the first tweak each step is a single XOR with one of a handful of
+        K2 x (2^(t + 1) - 1) values, all computed up front so that the tables
+        are never modified once shared between threads.
+        """
+        steps = self.steps
+        K2i = self.K2.mul(i)
+        for _ in range(count - 1):
+            yield K2i
+            K2i ^= steps[(i ^ (i + 1)).bit_length() - 1]
+            i += 1
+        if count > 0:
+            yield K2i
+
+    def pattern(self, m: int) -> int:
+        """
+        K2 x 0, K2 x 1, ... K2 x (2^m - 1) concatenated into one big endian integer.
+        Built by doubling: the second half of the first 2^(k + 1) tweaks is the first
+        half XORed with K2 x 2^k in every block.
+        """
+        if m not in self.patterns:
+            pattern = 0
+            for k in range(m):
+                n = 1 << k
+                pattern = (pattern << (LRW_blocksize * 8 * n)) | (pattern ^ (self.K2.mul(n) * _block_ones(n)))
+            self.patterns[m] = pattern
+        return self.patterns[m]
+
+    def stream(self, i, count) -> int:
+        """
+        The tweaks K2 x i ... K2 x (i + count - 1) concatenated into one big endian
+        integer, i.e. the value to XOR with count blocks of data in one go.
+
+        For a window of 2^m blocks starting at a multiple w of 2^m, w + j == w ^ j,
+        so by linearity K2 x (w + j) = (K2 x w) ^ (K2 x j). The K2 x j part is the
+        same for every window and is cached, leaving one multiplication and
+        a couple of big integer operations per window. Any run of count <= 2^m blocks
+        lies within two neighbouring windows.
+        """
+        if count <= 0:
+            return 0
+        K2 = self.K2
+        m = (count - 1).bit_length()
+        n = 1 << m
+        pattern = self.pattern(m)
+        ones = _block_ones(n)
+        w = i & ~(n - 1)
+        window_bits = LRW_blocksize * 8 * n
+        tweaks = ((pattern ^ (K2.mul(w) * ones)) << window_bits) | (pattern ^ (K2.mul(w + n) * ones))
+        # keep the count blocks starting at block i - w of the two windows
+        return (tweaks >> (LRW_blocksize * 8 * (2 * n - (i - w) - count))) & ((1 << (LRW_blocksize * 8 * count)) - 1)
+
+    def array(self, i, count):
+        """
+        NumPy version of stream(). Returns a (count, 2) uint64 array.
+
+        The array holds the tweak bytes as they are laid out in the data, i.e.
+        each 16 byte tweak is viewed as two native uint64 words without any byte
+        swapping. XOR does not care about byte order, so the array can be XORed
+        directly with numpy.frombuffer(data, numpy.uint64).reshape(-1, 2).
+        The same two window scheme as stream() is used, with the cached
+        pattern sliced instead of shifted.
+        """
+        if count <= 0:
+            return numpy.zeros((0, 2), dtype=numpy.uint64)
+        K2 = self.K2
+        m = (count - 1).bit_length()
+        n = 1 << m
+        if m not in self.pattern_arrays:
+            pattern = self.pattern(m).to_bytes(LRW_blocksize << m, 'big')
+            self.pattern_arrays[m] = numpy.frombuffer(pattern, dtype=numpy.uint64).reshape(-1, 2)
+        pattern = self.pattern_arrays[m]
+        w = i & ~(n - 1)
+        first = n - (i - w)  # number of blocks that fall within the first window
+        tweaks = numpy.empty((count, 2), dtype=numpy.uint64)
+        if count <= first:
+            tweaks[:] = pattern[i - w:i - w + count]
+        else:
+            tweaks[:first] = pattern[i - w:]
+            tweaks[first:] = pattern[:count - first]
+        for K2w, rows in ((K2.mul(w), tweaks[:first]), (K2.mul(w + n), tweaks[first:])):
+            rows ^= numpy.frombuffer(K2w.to_bytes(LRW_blocksize, 'big'), dtype=numpy.uint64)
+        return tweaks
+
+@functools.lru_cache(maxsize=32)
+def _lrw_tweak_tables(K2: GF128Multiplier) -> _LRWTweakTables:
+    return _LRWTweakTables(K2)
+
+def lrw_tweak_tables(lrwkey, cached=True) -> _LRWTweakTables:
+    """
+    The tweak tables for the LRW key K2, shared by everyone using the same
+    key. With cached=False they belong to the caller, see lrw_multiplier().
+    """
+    if not cached:
+        return _LRWTweakTables(lrw_multiplier(lrwkey, cached=False))
+    return _lrw_tweak_tables(lrw_multiplier(lrwkey))
+
+def LRWTweaks(lrwkey, i, count):
+    """Yields the tweaks K2 x i, K2 x (i + 1), ... K2 x (i + count - 1), one XOR each."""
+    return lrw_tweak_tables(lrwkey).tweaks(i, count)
+
+def LRWTweakStream(lrwkey, i, count) -> int:
+    """The tweaks K2 x i ... K2 x (i + count - 1) concatenated into one big endian integer."""
+    return lrw_tweak_tables(lrwkey).stream(i, count)
+
+def LRWTweakArray(lrwkey, i, count):
+    """NumPy version of LRWTweakStream(). Returns a (count, 2) uint64 array."""
+    return lrw_tweak_tables(lrwkey).array(i, count)
+
+def _xor_tweak_array(data, tweaks) -> bytes:
+    return (numpy.frombuffer(data, dtype=numpy.uint64).reshape(-1, 2) ^ tweaks).tobytes()
+
 def LRWMany(cipherfunc, lrwkey, i, blocks) -> bytes:
     num_blocks = len(blocks)
     if False is (num_blocks % LRW_blocksize == 0): raise AssertionError('the num_blocks does not divide equally by blocksize')
-    data = b''
-    for b in range(num_blocks // LRW_blocksize):
-        data += LRW(cipherfunc, lrwkey, i + b, blocks[0:16])
-        blocks = blocks[16:]
-    return data
+    offsets = range(0, num_blocks, LRW_blocksize)
+    if numpy is not None and len(offsets) >= LRW_numpy_min_blocks:
+        # Both XOR passes as single array operations, the cipher still gets one block per call.
+        tweaks = LRWTweakArray(lrwkey, i, len(offsets))
+        blocks = _xor_tweak_array(blocks, tweaks)
+        blocks = b''.join([cipherfunc(blocks[offset:offset + LRW_blocksize]) for offset in offsets])
+        return _xor_tweak_array(blocks, tweaks)
+    data = []
+    for offset, K2i in zip(offsets, LRWTweaks(lrwkey, i, len(offsets))):
+        # C_i = E_K1(P_i ^ K2i) ^ K2i
+        block = (str2int(blocks[offset:offset + LRW_blocksize]) ^ K2i).to_bytes(LRW_blocksize, 'big')
+        block = (str2int(cipherfunc(block)) ^ K2i).to_bytes(LRW_blocksize, 'big')
+        data.append(block)
+    return b''.join(data)
+
+def _lrw_crypt(tables, cipherfunc, i, data) -> bytes:
+    size = len(data)
+    if False is (size % LRW_blocksize == 0): raise AssertionError('the data size does not divide equally by blocksize')
+    if numpy is not None and size // LRW_blocksize >= LRW_numpy_min_blocks:
+        tweaks = tables.array(i, size // LRW_blocksize)
+        return _xor_tweak_array(cipherfunc(_xor_tweak_array(data, tweaks)), tweaks)
+    tweaks = tables.stream(i, size // LRW_blocksize)
+    data = (str2int(data) ^ tweaks).to_bytes(size, 'big')
+    return (str2int(cipherfunc(data)) ^ tweaks).to_bytes(size, 'big')
+
+def _lrw_crypt_into(tables, cipher_into, i, dst, src) -> None:
+    size = len(src)
+    if False is (size % LRW_blocksize == 0): raise AssertionError('the data size does not divide equally by blocksize')
+    if False is (len(dst) == size): raise AssertionError('dst and src must have the same size')
+    if numpy is not None and size // LRW_blocksize >= LRW_numpy_min_blocks:
+        tweaks = tables.array(i, size // LRW_blocksize)
+        words = numpy.frombuffer(dst, dtype=numpy.uint64).reshape(-1, 2)
+        numpy.bitwise_xor(numpy.frombuffer(src, dtype=numpy.uint64).reshape(-1, 2), tweaks, out=words)
+        cipher_into(dst, dst)
+        words ^= tweaks
+        return
+    tweaks = tables.stream(i, size // LRW_blocksize)
+    dst[:] = (str2int(src) ^ tweaks).to_bytes(size, 'big')
+    cipher_into(dst, dst)
+    dst[:] = (str2int(dst) ^ tweaks).to_bytes(size, 'big')
+
+def _cipher_into(cipher, name):
+    """cipher.encrypt_into or cipher.decrypt_into, or an adapter if cipher only has encrypt() and decrypt()."""
+    into = getattr(cipher, name + '_into', None)
+    if into is None:
+        cipherfunc = getattr(cipher, name)
+        def into(dst, src):
+            dst[:] = cipherfunc(bytes(src))
+    return into
+
+def LRWSector(cipherfunc, lrwkey, i, data) -> bytes:
+    """
+    LRW over a whole sector, or any run of consecutive blocks, at once.
+
+    The result is the same as LRWMany() but the data is XORed with the
+    complete tweak stream as one big integer, cipherfunc is called once
+    for the whole buffer and the result is XORed again. cipherfunc must
+    therefore accept any multiple of 16 bytes, not just a single block.
+    The buffer can be as large as the caller likes; with a native cipher
+    such as AES a chunk of a few MiB costs little more than the cipher itself.
+    """
+    return _lrw_crypt(lrw_tweak_tables(lrwkey), cipherfunc, i, data)
+
+class LRWContext:
+    """
+    LRW mode for one keyed cipher and one LRW key.
+
+    The key dependent work (parsing and checking lrwkey, the K2 tables and
+    the tweak patterns) is done once when the context is created, so
+    encrypting or decrypting a run of blocks only computes its tweaks and
+    makes one call into the cipher. cipher is any object with encrypt() and
+    decrypt() methods that accept multiples of 16 bytes, e.g. a CipherChain.
+    The tables are not cached, they go away with the context.
+    """
+
+    def __init__(self, cipher, lrwkey):
+        if False is (LRW_blocksize == len(lrwkey)): raise AssertionError(f'lrwkey size must be {LRW_blocksize}')
+        self.cipher = cipher
+        self.lrwkey = bytes(lrwkey)
+        self.tables = lrw_tweak_tables(self.lrwkey, cached=False)
+
+    def encrypt_blocks(self, index, buf) -> bytes:
+        """Encrypt the blocks in buf, the first of which has LRW block index index."""
+        return _lrw_crypt(self.tables, self.cipher.encrypt, index, buf)
+
+    def decrypt_blocks(self, index, buf) -> bytes:
+        """Decrypt the blocks in buf, the first of which has LRW block index index."""
+        return _lrw_crypt(self.tables, self.cipher.decrypt, index, buf)
+
+    def encrypt_blocks_into(self, index, dst, src) -> None:
+        """
+        Encrypt the blocks in src into the writable buffer dst (a bytearray,
+        memoryview, ...) of the same size. dst may be src, so a buffer can be
+        encrypted in place without intermediate copies if the cipher has an
+        encrypt_into() method.
+        """
+        _lrw_crypt_into(self.tables, _cipher_into(self.cipher, 'encrypt'), index, dst, src)
+
+    def decrypt_blocks_into(self, index, dst, src) -> None:
+        """Decrypt the blocks in src into dst, see encrypt_blocks_into()."""
+        _lrw_crypt_into(self.tables, _cipher_into(self.cipher, 'decrypt'), index, dst, src)
@@ -37,15 +37,15 @@ key_size = 32
 
 class Serpent:
     
-    def __init__(self, key=None):
+    def __init__(self, key=None, specialize=False):
         """Serpent."""
         
         if key:
-            self.set_key(key)
+            self.set_key(key, specialize)
 
 
-    def set_key(self, key):
-        """Init."""
+    def set_key(self, key, specialize=False):
+        """Init. With specialize, one block calls use code compiled for this key, kept by this instance."""
         
         key_len = len(key)
         if key_len % 4:
@@ -66,41 +66,49 @@ class Serpent:
 
         set_key(self.key_context, key_word32, key_len)        
 
+        self.encrypt_block = encrypt
+        self.decrypt_block = decrypt
+        if specialize and keyed_available():
+            self.encrypt_block = keyed_function(encrypt, tuple(self.key_context))
+            self.decrypt_block = keyed_function(decrypt, tuple(self.key_context))
+
         
     def decrypt(self, block):
         """Decrypt blocks."""
-        
-        if len(block) % 16:
+
+        plaintext = bytearray(len(block))
+        self.decrypt_into(plaintext, block)
+        return bytes(plaintext)
+
+
+    def decrypt_into(self, dst, src):
+        """Decrypt the blocks in src into the writable buffer dst. dst may be src."""
+
+        if len(src) % 16:
             raise ValueError("block size must be a multiple of 16")
+        if len(dst) != len(src):
+            raise ValueError("dst and src must have the same size")
 
-        plaintext = b''
-        
-        while block:
-            a, b, c, d = struct.unpack("<4L", block[:16])
-            temp = [a, b, c, d]
-            decrypt(self.key_context, temp)
-            plaintext += struct.pack("<4L", *temp)
-            block = block[16:]
-            
-        return plaintext
+        backends.select('Serpent', len(src) // 16).crypt_into(self, 'decrypt', dst, src)
 
         
     def encrypt(self, block):
         """Encrypt blocks."""
 
-        if len(block) % 16:
+        ciphertext = bytearray(len(block))
+        self.encrypt_into(ciphertext, block)
+        return bytes(ciphertext)
+
+
+    def encrypt_into(self, dst, src):
+        """Encrypt the blocks in src into the writable buffer dst. dst may be src."""
+
+        if len(src) % 16:
             raise ValueError("block size must be a multiple of 16")
+        if len(dst) != len(src):
+            raise ValueError("dst and src must have the same size")
 
-        ciphertext = b''
-        
-        while block:
-            a, b, c, d = struct.unpack("<4L", block[0:16])
-            temp = [a, b, c, d]
-            encrypt(self.key_context, temp)
-            ciphertext += struct.pack("<4L", *temp)
-            block = block[16:]
-            
-        return ciphertext
+        backends.select('Serpent', len(src) // 16).crypt_into(self, 'encrypt', dst, src)
 
 
     def get_name(self):
@@ -128,6 +136,8 @@ class Serpent:
 import struct
 import sys
 
+import backends
+
 WORD_BIGENDIAN = 0
 if sys.byteorder == 'big':
     WORD_BIGENDIAN = 1
@@ -2955,3 +2965,205 @@ def decrypt(key, in_blk):
     in_blk[1] = b
     in_blk[2] = c
     in_blk[3] = d
+
+
+#
+# Derived engines.
+#
+# encrypt() and decrypt() above are straight-line code over four 32 bit
+# words. The multi-block engines below are derived from their source with
+# a few textual rewrites and compiled on first use, so the round code
+# exists only once.
+#
+
+import re
+import array
+import functools
+import inspect
+
+try:
+    import numpy
+except ImportError:
+    # NumPy is optional; without it the NumPy engine is simply not used.
+    numpy = None
+
+def derive_function(func, name, params, substitutions, unsupported):
+    """
+    Compile a copy of encrypt() or decrypt() taking the extra params, with
+    the (pattern, repl) regex substitutions applied. Raises ValueError if
+    the result still matches the unsupported pattern.
+    """
+    src = inspect.getsource(func)
+    src = src.replace(f'def {func.__name__}(key, in_blk):', f'def {func.__name__}(key, in_blk{params}):')
+    for pattern, repl in substitutions:
+        src = re.sub(pattern, repl, src)
+    if re.search(unsupported, src):
+        raise ValueError(f'{func.__name__}() has operations the {name} rewrite does not handle')
+    namespace = {'WORD_BIGENDIAN': 0, 'rotl32': rotl32, 'rotr32': rotr32}
+    exec(compile(src, f'<serpent {name} {func.__name__}>', 'exec'), namespace)
+    return namespace[func.__name__]
+
+def derived_available(engine):
+    """
+    The derived engines take the little endian words that the one block
+    engine gets from struct.unpack("<4L"). On big endian hosts that engine
+    additionally byte swaps every word, which they do not replicate.
+    """
+    if WORD_BIGENDIAN:
+        return False
+    try:
+        engine(encrypt)
+        engine(decrypt)
+    except (OSError, TypeError, ValueError):
+        return False  # e.g. no source code available to rewrite
+    return True
+
+#
+# Lane-packed (SIMD within a register) engine.
+#
+# The S-boxes are boolean circuits over whole 32 bit words, so N
+# blocks can be processed at once by packing word j of every block into
+# one N * 32 bit Python integer, block k in bits 32k to 32k + 31 (a
+# "lane"). AND, OR and XOR then work on every lane in one big integer
+# operation. Only NOT, the shifts and the rotations need care so that no
+# bits leak across lanes. They are done with lane masks:
+#   ~x           -> x ^ M                  (M is all ones in every lane)
+#   (x << n)     -> (x << n) & H[n]        (H[n] is bits n to 31 of every lane)
+#   rotl32(x, n) -> ((x << n) & H[n]) | ((x >> (32 - n)) & L[n])
+#                                          (L[n] is bits 0 to n - 1 of every lane)
+# The interpreter overhead per round is then shared by all N blocks.
+
+LANES_MIN_BLOCKS = 2  # fewer blocks than this use the one block engine without calibration
+LANES_MAX_BLOCKS = 4096  # larger inputs are processed in batches of this many blocks
+
+def _lanes_rotl(m):
+    x, n = m.group(2), int(m.group(3))
+    if m.group(1) == 'r':
+        n = 32 - n
+    return f'(((({x} << {n}) & H[{n}]) | ({x} >> {32 - n}) & L[{n}]))'
+
+@functools.lru_cache(maxsize=None)
+def lanes_function(func):
+    """Compile the lane-packed version of encrypt() or decrypt()."""
+    return derive_function(func, 'lanes', ', M, H, L', [
+        (r'rot([lr])32\((\w+), (\d+)\)', _lanes_rotl),
+        (r'\((\w+) << (\d+)\) & 0xFFFFFFFF', r'(\1 << \2) & H[\2]'),
+        (r'\(~(\w+)\) % 0x100000000', r'(\1 ^ M)'),
+    ], r'0xFFFFFFFF|0x100000000|rot[lr]32|~')
+
+@functools.lru_cache(maxsize=None)
+def lanes_available():
+    """Packing also needs array('I') to hold 32 bit words."""
+    return array.array('I').itemsize == 4 and derived_available(lanes_function)
+
+@functools.lru_cache(maxsize=4)
+def lanes_masks(n):
+    """The lane masks M, H and L, see above, for n lanes."""
+    rep = int.from_bytes(b'\x01\x00\x00\x00' * n, 'little')  # 1 in every lane
+    M = rep * 0xFFFFFFFF
+    H = [rep * ((0xFFFFFFFF << k) & 0xFFFFFFFF) for k in range(32)]
+    L = [rep * ((1 << k) - 1) for k in range(32)]
+    return rep, M, H, L
+
+def crypt_lanes(func, key, block):
+    """Run encrypt() or decrypt() over all the blocks in block at once."""
+    lanes_func = lanes_function(func)
+    out = array.array('I', bytes(len(block)))
+    for start in range(0, len(block), 16 * LANES_MAX_BLOCKS):
+        words = array.array('I')
+        words.frombytes(block[start:start + 16 * LANES_MAX_BLOCKS])  # also takes a memoryview
+        n = len(words) // 4
+        rep, M, H, L = lanes_masks(n)
+        # word j of all n blocks, block k in lane k
+        lanes = [int.from_bytes(words[j::4].tobytes(), 'little') for j in range(4)]
+        lanes_func([k * rep for k in key], lanes, M, H, L)
+        for j in range(4):
+            words[j::4] = array.array('I', lanes[j].to_bytes(4 * n, 'little'))
+        out[start // 4:start // 4 + 4 * n] = words
+    return out.tobytes()
+
+#
+# NumPy engine.
+#
+# The same straight-line code runs unchanged on uint32 arrays holding word
+# j of N blocks: the operators work element-wise, uint32 shifts drop the
+# bits that rotl32()/rotr32() mask away, and the 140 word key context is
+# broadcast across all blocks. Only ~x needs rewriting because uint32 ~x
+# is already reduced modulo 2^32. Each operation costs a fixed NumPy call
+# plus very little per block, so this beats the lanes for large batches.
+
+NUMPY_MIN_BLOCKS = 2048  # measured crossover with the lane engine, used without calibration
+NUMPY_MAX_BLOCKS = 16384  # larger inputs are processed in batches of this many blocks
+
+@functools.lru_cache(maxsize=None)
+def numpy_function(func):
+    """Compile the NumPy version of encrypt() or decrypt()."""
+    return derive_function(func, 'numpy', '', [
+        (r'\(~(\w+)\) % 0x100000000', r'(~\1)'),
+    ], r'0x100000000')
+
+@functools.lru_cache(maxsize=None)
+def numpy_available():
+    return numpy is not None and derived_available(numpy_function)
+
+def crypt_numpy(func, key, block):
+    """Run encrypt() or decrypt() over all the blocks in block as (N, 4) uint32 arrays."""
+    numpy_func = numpy_function(func)
+    key = [numpy.uint32(k) for k in key]
+    words = numpy.frombuffer(block, dtype='<u4').reshape(-1, 4)
+    out = numpy.empty(words.shape, dtype='<u4')
+    for start in range(0, len(words), NUMPY_MAX_BLOCKS):
+        batch = words[start:start + NUMPY_MAX_BLOCKS]
+        columns = [batch[:, j].astype(numpy.uint32) for j in range(4)]
+        numpy_func(key, columns)
+        for j in range(4):
+            out[start:start + NUMPY_MAX_BLOCKS, j] = columns[j]
+    return out.tobytes()
+
+#
+# Per-key engine.
+#
+# encrypt() and decrypt() read 132 round key words from the key context,
+# one list subscript each. For a fixed key, e.g. a mounted volume, they
+# are compiled once more with the words as integer constants. The key
+# argument is then ignored. The compiled functions hold the round keys, so
+# only the Serpent instance keeps them, there is no cache by key.
+
+def _keyed_word(key):
+    return lambda m: f'0x{key[4 * int(m.group(1)) + int(m.group(2))]:08x}'
+
+def keyed_function(func, key):
+    """Compile encrypt() or decrypt() for the key context key, a tuple."""
+    return derive_function(func, 'keyed', '', [
+        (r'key\[4 \* *(\d+) \+ *(\d+)\]', _keyed_word(key)),
+    ], r'key\[')
+
+def _keyed_probe(func):
+    return keyed_function(func, tuple(range(140)))
+
+@functools.lru_cache(maxsize=None)
+def keyed_available():
+    return derived_available(_keyed_probe)
+
+#
+# Backends, see backends.py.
+#
+
+def crypt_block_into(cipher, direction, dst, src):
+    """The one block engine, with the key specialized functions of cipher if it has them."""
+    block_function = cipher.encrypt_block if direction == 'encrypt' else cipher.decrypt_block
+    for offset in range(0, len(src), 16):
+        temp = list(struct.unpack_from("<4L", src, offset))
+        block_function(cipher.key_context, temp)
+        struct.pack_into("<4L", dst, offset, *temp)
+
+def _engine_into(engine):
+    functions = {'encrypt': encrypt, 'decrypt': decrypt}
+    def crypt_into(cipher, direction, dst, src):
+        dst[:] = engine(functions[direction], cipher.key_context, src)
+    return crypt_into
+
+backends.register_cipher('Serpent', Serpent, key_size)
+backends.register('Serpent', 'block', crypt_block_into)
+backends.register('Serpent', 'lanes', _engine_into(crypt_lanes), lanes_available, LANES_MIN_BLOCKS)
+backends.register('Serpent', 'numpy', _engine_into(crypt_numpy), numpy_available, NUMPY_MIN_BLOCKS)
@@ -27,10 +27,13 @@
 
 import sys
 import os
+import ctypes
+import functools
 
 from Crypto.Cipher import AES
+import backends
 from serpent import Serpent
-from twofish import Twofish
+import twofish
 from lrw import *
 from keystrengthening import *
 
@@ -39,10 +42,101 @@ class Rijndael:
         self.cipher = AES.new(key, AES.MODE_ECB)
 
     def encrypt(self, plaintext):
-        return self.cipher.encrypt(plaintext)
+        ciphertext = bytearray(len(plaintext))
+        self.encrypt_into(ciphertext, plaintext)
+        return bytes(ciphertext)
 
     def decrypt(self, ciphertext):
-        return self.cipher.decrypt(ciphertext)
+        plaintext = bytearray(len(ciphertext))
+        self.decrypt_into(plaintext, ciphertext)
+        return bytes(plaintext)
+
+    def encrypt_into(self, dst, src):
+        backends.select('Rijndael', len(src) // 16).crypt_into(self, 'encrypt', dst, src)
+
+    def decrypt_into(self, dst, src):
+        backends.select('Rijndael', len(src) // 16).crypt_into(self, 'decrypt', dst, src)
+
+def _rijndael_pycryptodome_into(cipher, direction, dst, src):
+    getattr(cipher.cipher, direction)(src, output=dst)
+
+backends.register_cipher('Rijndael', Rijndael, 32)
+backends.register('Rijndael', 'pycryptodome', _rijndael_pycryptodome_into)
+
+@functools.lru_cache(maxsize=None)
+def _twofish_functions():
+    """
+    The block functions of the C library behind the twofish package, taking
+    plain addresses, or None if the library cannot be reached. The library
+    is loaded through a handle of our own so the package's own argtypes
+    stay untouched.
+    """
+    try:
+        library = ctypes.CDLL(twofish._twofish._name)
+        functions = library.exp_Twofish_encrypt, library.exp_Twofish_decrypt
+    except (AttributeError, OSError):
+        return None
+    for function in functions:
+        function.argtypes = [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p]
+        function.restype = None
+    return {'encrypt': functions[0], 'decrypt': functions[1]}
+
+class Twofish:
+    """
+    Wraps the twofish package, which only handles one 16 byte block per call,
+    so that any multiple of 16 bytes can be processed per call.
+
+    The "ctypes" backend processes the buffer in place, calling the C block
+    functions directly with addresses, which skips the per block output
+    allocation and type checks of twofish.Twofish. The "package" backend
+    loops over the cached bound methods of twofish.Twofish.
+    """
+    def __init__(self, key):
+        self.cipher = twofish.Twofish(key)
+        self.block_functions = {'encrypt': self.cipher.encrypt, 'decrypt': self.cipher.decrypt}
+        self.key_address = ctypes.addressof(self.cipher.key)
+
+    def _crypt_into(self, direction, dst, src):
+        size = len(src)
+        if size % 16: raise ValueError('block size must be a multiple of 16')
+        if len(dst) != size: raise ValueError('dst and src must have the same size')
+        if size:
+            backends.select('Twofish', size // 16).crypt_into(self, direction, dst, src)
+
+    def encrypt(self, plaintext):
+        ciphertext = bytearray(plaintext)
+        self._crypt_into('encrypt', ciphertext, ciphertext)
+        return bytes(ciphertext)
+
+    def decrypt(self, ciphertext):
+        plaintext = bytearray(ciphertext)
+        self._crypt_into('decrypt', plaintext, plaintext)
+        return bytes(plaintext)
+
+    def encrypt_into(self, dst, src):
+        self._crypt_into('encrypt', dst, src)
+
+    def decrypt_into(self, dst, src):
+        self._crypt_into('decrypt', dst, src)
+
+def _twofish_ctypes_into(cipher, direction, dst, src):
+    if dst is not src:
+        dst[:] = src
+    # the C functions read the whole block before writing it, so in place is fine
+    address = ctypes.addressof((ctypes.c_char * len(dst)).from_buffer(dst))
+    function, key_address = _twofish_functions()[direction], cipher.key_address
+    for block_address in range(address, address + len(dst), 16):
+        function(key_address, block_address, block_address)
+
+def _twofish_package_into(cipher, direction, dst, src):
+    block_function = cipher.block_functions[direction]
+    dst, src = memoryview(dst), memoryview(src)
+    for i in range(0, len(src), 16):
+        dst[i:i + 16] = block_function(bytes(src[i:i + 16]))
+
+backends.register_cipher('Twofish', Twofish, 32)
+backends.register('Twofish', 'ctypes', _twofish_ctypes_into, lambda: _twofish_functions() is not None)
+backends.register('Twofish', 'package', _twofish_package_into)
 
 #
 # Utilities.
@@ -83,7 +177,8 @@ def Win32FileTime2UnixTime(filetime):
 
 class CipherChain:
     def __init__(self, ciphers):
-        self.cipher_list = ciphers
+        # cipher classes or names registered in backends
+        self.cipher_list = [backends.cipher(cipher) if isinstance(cipher, str) else cipher for cipher in ciphers]
         self.ciphers = [None] * len(self.cipher_list)
     def set_key(self, keys):
         for i, cipher in enumerate(self.cipher_list):
@@ -100,18 +195,27 @@ class CipherChain:
             # data is accumulated each iteration
             data = cipher.decrypt(data)
         return data
+    def encrypt_into(self, dst, src):
+        # the first cipher writes to dst, the others work in place
+        for cipher in self.ciphers:
+            cipher.encrypt_into(dst, src)
+            src = dst
+    def decrypt_into(self, dst, src):
+        for cipher in reversed(self.ciphers):
+            cipher.decrypt_into(dst, src)
+            src = dst
     def get_name(self):
         return '-'.join(reversed([type(cipher).__name__ for cipher in self.ciphers]))
 
 Cascades = [
-    [Rijndael],
-    [Serpent],
-    [Twofish],
-    [Twofish, Rijndael],
-    [Serpent, Twofish, Rijndael],
-    [Rijndael, Serpent],
-    [Rijndael, Twofish, Serpent],
-    [Serpent, Twofish]
+    ['Rijndael'],
+    ['Serpent'],
+    ['Twofish'],
+    ['Twofish', 'Rijndael'],
+    ['Serpent', 'Twofish', 'Rijndael'],
+    ['Rijndael', 'Serpent'],
+    ['Rijndael', 'Twofish', 'Serpent'],
+    ['Serpent', 'Twofish']
 ]
 
 HMACs = [
@@ -126,15 +230,23 @@ HMACs = [
 
 TC_SECTOR_SIZE = 512
 TC_HIDDEN_VOLUME_OFFSET = 1536
+TC_CHUNK_SIZE = 1024 * 1024 # bytes decrypted per TCReadSectorsInto call by cmdline()
 
 class TrueCryptVolume:
     """Object representing a TrueCrypt volume."""
-    def __init__(self, fileobj, password, progresscallback=lambda x: None):
+    def __init__(self, fileobj, password, progresscallback=lambda x: None, executor=None):
+        """
+        Open the volume in fileobj with password. executor, e.g. a
+        concurrent.futures.ProcessPoolExecutor, is passed to PBKDF2Keypool()
+        to derive all header key blocks in one concurrent batch, instead of
+        only those the trials need one after the other. It is not used for the
+        hashes in PBKDF2_HASHLIB, which hashlib derives in one call.
+        """
 
         self.fileobj = fileobj
         self.decrypted_header = None
         self.cipher = None
-        self.master_lrwkew = None
+        self.lrw = None
         self.hidden_size = 0
 
         for volume_type in ["normal", "hidden"]:
@@ -158,22 +270,29 @@ class TrueCryptVolume:
 
                 progresscallback("Trying " + hmac_name)
                 
-                header_keypool = PBKDF2(hmac, password, salt, iterations, 128)
+                # The keypool is derived as its keys are used, so without an
+                # executor a single cipher volume only derives the LRW key and
+                # key 1. With one it is derived in one concurrent batch.
+                header_keypool = PBKDF2Keypool(hmac, password, salt, iterations, 128, executor)
                 header_lrwkey = header_keypool[0:16]
-                header_key1 = header_keypool[32:64]
-                header_key2 = header_keypool[64:96]
-                header_key3 = header_keypool[96:128]
+                header_keys = TCKeypoolKeys(header_keypool)
+                trial = TCHeaderTrial(header, header_lrwkey, header_keys)
 
-                for cascade in Cascades:
+                # Single ciphers first, they need the fewest keys.
+                for cascade in sorted(Cascades, key=len):
                     # Try each cipher and cascades and see if we can successfully
                     # decrypt the header with it.
                     cipher = CipherChain(cascade)
                     
-                    cipher.set_key([header_key1, header_key2, header_key3])
+                    trial.set_key(cipher)
 
                     progresscallback("..." + cipher.get_name())
 
-                    decrypted_header = LRWMany(cipher.decrypt, header_lrwkey, 1, header)
+                    # The magic is in the first LRW block. Only decrypt the
+                    # whole header and check the CRC if it matches.
+                    if trial.decrypt(cipher, 1)[0:4] != TC_HEADER_MAGIC:
+                        continue
+                    decrypted_header = trial.decrypt(cipher)
                     if TCIsValidVolumeHeader(decrypted_header):
                         # Success.
                         self.decrypted_header = decrypted_header
@@ -184,9 +303,9 @@ class TrueCryptVolume:
                         master_key2 = master_keypool[64:96]
                         master_key3 = master_keypool[96:128]
 
-                        self.master_lrwkey = master_lrwkey
                         self.cipher = cipher
                         self.cipher.set_key([master_key1, master_key2, master_key3])
+                        self.lrw = LRWContext(self.cipher, master_lrwkey)
                         self.hidden_size = BE64(decrypted_header[28:28+8])
                         self.format_ver = BE16(decrypted_header[4:6])
 
@@ -194,7 +313,8 @@ class TrueCryptVolume:
                         # it so it can be displayed by print_information()
                         self.info_hash = hmac_name
                         self.info_headerlrwkey = hexdigest(header_lrwkey)
-                        self.info_headerkey = hexdigest(header_keypool[32:128])
+                        # only the keys of this cascade, the rest need not be derived
+                        self.info_headerkey = hexdigest(b''.join(header_keys[i] for i in range(len(cascade))))
                         self.info_masterkey = hexdigest(master_keypool[32:128])
 
                         progresscallback("Success!")
@@ -207,52 +327,176 @@ class TrueCryptVolume:
             return "<TrueCryptVolume>"
         return "<TrueCryptVolume %s %s>" % (self.cipher.get_name(), self.info_hash)
 
+class TCKeypoolKeys:
+    """The cipher keys of a 128 byte keypool, bytes 32-63, 64-95 and 96-127, sliced on demand."""
+    def __init__(self, keypool):
+        self.keypool = keypool
+
+    def __len__(self):
+        return 3
+
+    def __getitem__(self, i):
+        if not 0 <= i < 3: raise IndexError('keypool key index out of range')
+        return bytes(self.keypool[32 + 32 * i:64 + 32 * i])
+
+class TCHeaderTrial:
+    """
+    Decrypts one volume header with any number of cascades for one set of
+    header keys, sharing the work they have in common.
+
+    LRW decryption is P = D(C ^ T) ^ T, and the tweaks T depend only on
+    the LRW key, so the tweak stream and the input XOR C ^ T are computed
+    once for all cascades. The cascade stages form a trie: the decryption
+    path of a cascade is its (cipher, key) stages in decryption order, and
+    the output of each path prefix is computed once, so a stage shared by
+    cascades, i.e. the same cipher and key on the same input, runs once.
+
+    The cascades also key the same cipher classes with the same keys, e.g.
+    Serpent gets key 1 in three of them, so set_key() expands each (cipher,
+    key) pair once. Nothing here is cached beyond the trial object, so the
+    header key material goes away with it.
+    """
+    def __init__(self, header, lrwkey, keys):
+        self.keys = keys # any sequence of bytes, e.g. TCKeypoolKeys
+        self.tweaks = lrw_tweak_tables(lrwkey, cached=False).stream(1, len(header) // LRW_blocksize)
+        self.whitened = (str2int(header) ^ self.tweaks).to_bytes(len(header), 'big')
+        self.stages = {} # (size, path prefix) -> output
+        self.schedules = {} # (cipher class, key index) -> keyed cipher
+
+    def set_key(self, cipher):
+        """Key cipher, a CipherChain, with keys, sharing keyed ciphers with the other cascades."""
+        for i, cipher_class in enumerate(cipher.cipher_list):
+            if (cipher_class, i) not in self.schedules:
+                self.schedules[cipher_class, i] = cipher_class(self.keys[i])
+            cipher.ciphers[i] = self.schedules[cipher_class, i]
+
+    def decrypt(self, cipher, num_blocks=None):
+        """
+        Decrypt the header with cipher, a CipherChain keyed with keys. With
+        num_blocks only the first num_blocks LRW blocks are decrypted.
+        """
+        data = self.whitened
+        if num_blocks is not None:
+            data = data[:num_blocks * LRW_blocksize]
+        path = ()
+        for i in reversed(range(len(cipher.ciphers))):
+            path += ((cipher.cipher_list[i], self.keys[i]),)
+            if (len(data), path) not in self.stages:
+                self.stages[len(data), path] = cipher.ciphers[i].decrypt(data)
+            data = self.stages[len(data), path]
+        tweaks = self.tweaks >> (8 * (len(self.whitened) - len(data)))
+        return (str2int(data) ^ tweaks).to_bytes(len(data), 'big')
+
+TC_HEADER_MAGIC = b'TRUE'
+
 def TCIsValidVolumeHeader(header):
     magic = header[0:4]
     checksum = BE32(header[8:12])
-    return magic == b'TRUE' and CRC32(header[192:448]) == checksum
+    return magic == TC_HEADER_MAGIC and CRC32(header[192:448]) == checksum
 
 def TCReadSector(tc, index):
     """Read a sector from the volume."""
-    if False is (index > 0): raise AssertionError('index is expected to be greater than zero')
+    return TCReadSectors(tc, index, 1)
+
+def TCDataExtent(tc):
+    """
+    File offsets (start, end) of the encrypted file system data, i.e.
+    sector 1 starts at start and the last sector ends at end.
+    """
     tc.fileobj.seek(0, 2)
     file_len = tc.fileobj.tell()
 
-    # The LRW functions work on blocks of length 16. Since a TrueCrypt
-    # sector is 512 bytes each call to LRWMany will decrypt 32 blocks,
-    # and each call to this function must therefore advance the block
-    # index 32. The block index also starts at 1, not 0. index 1
-    # corresponds to lrw_index 1, index 2 corresponds to lrw_index 33 etc.
-    lrw_index = (index - 1) * 32 + 1 # LRWSector2Index(index)
-
     # For a regular (non-hidden) volume the file system starts at byte
-    # 512. However for a hidden volume, the start of the file system
+    # 512, right after the salt+header, and runs to the end of the file.
+    # However for a hidden volume, the start of the file system
     # is not at byte 512. Starting from the end of the volume, namely
     # byte file_len, we subtract the hidden volume salt+header (at offset
     # 1536 from the end of the file). We then subtract the size of the
-    # hidden volume.
-    mod = 0
-    last_sector_offset = TC_SECTOR_SIZE
+    # hidden volume. For hidden volumes we must not read past the
+    # headers, so the last sector ends at the header offset.
     if tc.hidden_size:
-        mod = file_len - tc.hidden_size - TC_HIDDEN_VOLUME_OFFSET
-        # We subtract another sector from mod because the index starts
-        # at 1 and not 0.
-        mod -= TC_SECTOR_SIZE
-        last_sector_offset = TC_SECTOR_SIZE + TC_HIDDEN_VOLUME_OFFSET
-    seekto = mod + TC_SECTOR_SIZE * index
-
-    # last_sector_offset is the beginning of the last sector relative
-    # the end of the file. For a regular non-hidden volume this is simply
-    # 512 bytes from the end of the file. However for hidden volumes we
-    # must not read past the headers, so the last sector begins 512 bytes
-    # before the header offset.
-    if seekto > file_len - last_sector_offset:
-        return ''
+        end = file_len - TC_HIDDEN_VOLUME_OFFSET
+        return end - tc.hidden_size, end
+    return TC_SECTOR_SIZE, file_len
+
+def _TCSectorRun(tc, index, count):
+    """The file offset, LRW block index and clipped count of a sector run."""
+    if False is (index > 0): raise AssertionError('index is expected to be greater than zero')
+    start, end = TCDataExtent(tc)
+
+    # The LRW functions work on blocks of length 16. Since a TrueCrypt
+    # sector is 512 bytes each sector holds 32 LRW blocks, and each
+    # sector must therefore advance the block index 32. The block index
+    # also starts at 1, not 0. index 1 corresponds to lrw_index 1,
+    # index 2 corresponds to lrw_index 33 etc. The blocks of consecutive
+    # sectors are consecutive so a run of sectors is a single LRW run.
+    lrw_index = (index - 1) * 32 + 1 # LRWSector2Index(index)
+
+    seekto = start + TC_SECTOR_SIZE * (index - 1)
+    count = min(count, (end - seekto) // TC_SECTOR_SIZE)
+    return seekto, lrw_index, max(count, 0)
+
+def TCReadSectors(tc, index, count):
+    """
+    Read up to count consecutive sectors starting at index. Fewer are
+    returned if the volume ends first.
 
+    The sectors are read with one file read and decrypted with one
+    LRWContext.decrypt_blocks() call, so the per call overhead is shared
+    by all of them. Reading in chunks of TC_CHUNK_SIZE bytes lets the AES
+    only volumes run at close to the speed of the native cipher.
+    """
+    seekto, lrw_index, count = _TCSectorRun(tc, index, count)
+    if count <= 0:
+        return b''
+
+    tc.fileobj.seek(seekto)
+    data = tc.fileobj.read(TC_SECTOR_SIZE * count)
+
+    return tc.lrw.decrypt_blocks(lrw_index, data)
+
+def TCReadSectorsInto(tc, index, buf):
+    """
+    Like TCReadSectors() but the sectors are read into and decrypted in
+    place in buf, a writable buffer whose size is a multiple of the sector
+    size, without allocating anything per sector. Returns the number of
+    bytes read, less than len(buf) if the volume ends first.
+    """
+    seekto, lrw_index, count = _TCSectorRun(tc, index, len(buf) // TC_SECTOR_SIZE)
+    if count <= 0:
+        return 0
+
+    view = memoryview(buf)[:TC_SECTOR_SIZE * count]
     tc.fileobj.seek(seekto)
-    data = tc.fileobj.read(TC_SECTOR_SIZE)
-    
-    return LRWMany(tc.cipher.decrypt, tc.master_lrwkey, lrw_index, data)          
+    if False is (tc.fileobj.readinto(view) == len(view)): raise AssertionError('short read from the volume file')
+    tc.lrw.decrypt_blocks_into(lrw_index, view, view)
+    return len(view)
+
+def TCReadBytes(tc, offset, size):
+    """
+    Read size bytes of the decrypted volume starting at byte offset, where
+    offset 0 is the first byte of sector 1. Fewer bytes are returned if the
+    volume ends first.
+
+    Each 16 byte LRW block can be decrypted on its own, so only the blocks
+    overlapping the range are read and decrypted. Reading a 4 byte field
+    costs one or two block decryptions instead of a whole sector.
+    """
+    if False is (offset >= 0): raise AssertionError('offset is expected to be zero or greater')
+    start, end = TCDataExtent(tc)
+    stop = min(offset + size, end - start)
+    if stop <= offset:
+        return b''
+
+    # LRW block n of the volume data has lrw_index n + 1, see TCReadSectors.
+    first_block = offset // LRW_blocksize
+    last_block = (stop + LRW_blocksize - 1) // LRW_blocksize
+    tc.fileobj.seek(start + first_block * LRW_blocksize)
+    data = tc.fileobj.read((last_block - first_block) * LRW_blocksize)
+    data = tc.lrw.decrypt_blocks(first_block + 1, data)
+
+    skip = offset - first_block * LRW_blocksize
+    return data[skip:skip + stop - offset]
 
 def TCSectorCount(tc):
     """How many sectors can we read with TCReadSector?"""
@@ -292,7 +536,7 @@ def TCPrintInformation(tc):
     print("Header Key    :", tc.info_headerkey)
     print("Header LRW Key:", tc.info_headerlrwkey)
     print("Master Key    :", tc.info_masterkey)
-    print("Master LRW Key:", hexdigest(tc.master_lrwkey))
+    print("Master LRW Key:", hexdigest(tc.lrw.lrwkey))
     print("Format ver    :", hex(tc.format_ver))
     print("Min prog. ver :", hex(program_ver))
     print("Volume create :", time.asctime(time.localtime(volume_create)))
@@ -301,11 +545,25 @@ def TCPrintInformation(tc):
 
 def cmdline():
     scriptname = sys.argv[0]
+    usage = f'{scriptname} [--backend cipher=backend,...] volumepath password outfile'
+    args = sys.argv[1:]
+    try:
+        backends.check_overrides(os.environ.get(backends.BACKENDS_ENV, ''))
+    except ValueError as e:
+        raise SystemExit(f'{backends.BACKENDS_ENV}: {e}')
+    if args[:1] == ['--backend']:
+        if len(args) < 2:
+            raise SystemExit(usage)
+        try:
+            backends.set_overrides(args[1])
+        except ValueError as e:
+            raise SystemExit(f'--backend: {e}')
+        args = args[2:]
     try:
         # TODO replace with argparse
-        path, password, outfile = sys.argv[1:]
+        path, password, outfile = args
     except ValueError:
-        raise SystemExit(f'{scriptname} volumepath password outfile')
+        raise SystemExit(usage)
 
     if outfile.lower() not in ['/dev/null', 'nul'] and os.path.exists(outfile):
         raise SystemExit(f"outfile {outfile} already exists. use another "
@@ -323,11 +581,13 @@ def cmdline():
                 with open(outfile, 'wb') as outfileobj:
                     num_sectors = TCSectorCount(tc)
                     num_written = 0
-                    for i in range(1, num_sectors + 1):
-                        if i % 100 == 0:
-                            Log(f"Decrypting sector {i} of {num_sectors}.")
-                        outfileobj.write(TCReadSector(tc, i))
-                        num_written += 1
+                    chunk_sectors = TC_CHUNK_SIZE // TC_SECTOR_SIZE
+                    chunk = memoryview(bytearray(TC_CHUNK_SIZE))
+                    for i in range(1, num_sectors + 1, chunk_sectors):
+                        Log(f"Decrypting sector {i} of {num_sectors}.")
+                        size = TCReadSectorsInto(tc, i, chunk[:TC_SECTOR_SIZE * min(chunk_sectors, num_sectors + 1 - i)])
+                        outfileobj.write(chunk[:size])
+                        num_written += size // TC_SECTOR_SIZE
             except IOError:
                 raise SystemExit(f'IOError/OSError: problems writing to the output file: {outfile}')
 
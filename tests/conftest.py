@@ -3,3 +3,6 @@ import os
 
 # Add the src directory to the Python path
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../src')))
+
+# Use the fixed backend thresholds instead of calibrating and caching in the home directory
+os.environ['PYTRUECRYPT_BACKENDS_CACHE'] = ''
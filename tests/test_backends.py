@@ -0,0 +1,61 @@
+import json
+import pytest
+import backends
+
+class XorCipher:
+    def __init__(self, key):
+        self.key = key[:16]
+
+def xor_into(cipher, direction, dst, src):
+    dst[:] = bytes(a ^ b for a, b in zip(src, cipher.key * (len(src) // 16)))
+
+def slow_xor_into(cipher, direction, dst, src):
+    for _ in range(20):
+        xor_into(cipher, direction, dst, src)
+
+@pytest.fixture
+def registry(monkeypatch):
+    # an empty registry holding only the test algorithm
+    for name in ('_ciphers', '_backends', '_plans', '_overrides'):
+        monkeypatch.setattr(backends, name, {})
+    backends.register_cipher('Xor', XorCipher, 16)
+    backends.register('Xor', 'slow', slow_xor_into)
+    backends.register('Xor', 'fast', xor_into, min_blocks=8)
+    backends.register('Xor', 'missing', xor_into, available=lambda: False)
+
+def test_backends_static_plan(registry):
+    assert backends.available('Xor') == ['slow', 'fast']
+    assert backends.cipher('Xor') is XorCipher
+    assert backends.select('Xor', 1).name == 'slow'
+    assert backends.select('Xor', 7).name == 'slow'
+    assert backends.select('Xor', 8).name == 'fast'
+    # ties go to the first registered backend
+    backends.register('Xor', 'slower', slow_xor_into, min_blocks=8)
+    assert backends.static_plan('Xor') == [(1, 'slow'), (8, 'fast')]
+    assert backends.select('Xor', 100).name == 'fast'
+
+def test_backends_calibrate(registry, monkeypatch, tmp_path):
+    path = tmp_path / 'cache' / 'backends.json'
+    monkeypatch.setenv(backends.BACKENDS_CACHE_ENV, str(path))
+    monkeypatch.setattr(backends, 'CALIBRATION_BLOCKS', (1, 4, 16))
+    assert backends.select('Xor', 1).name == 'fast'
+    cache = json.loads(path.read_text())
+    assert [name for _, name in cache['Xor']['plan']] == ['fast'] * 3
+    # the next process reads the cache instead of calibrating again
+    monkeypatch.setattr(backends, '_plans', {})
+    monkeypatch.setattr(backends, 'calibrate', None)
+    assert backends.select('Xor', 100).name == 'fast'
+
+def test_backends_overrides(registry, monkeypatch):
+    monkeypatch.setenv(backends.BACKENDS_ENV, 'Xor=fast, Other=x')
+    assert backends.select('Xor', 1).name == 'fast'
+    backends.set_overrides('Xor=slow')
+    assert backends.select('Xor', 100).name == 'slow'
+    for spec in ('Xor=missing', 'Xor=unknown', 'Unknown=slow', 'Xor'):
+        with pytest.raises(ValueError):
+            backends.set_overrides(spec)
+    backends.set_overrides('')
+    assert backends.check_overrides('Xor=fast') == {'Xor': 'fast'}
+    monkeypatch.setenv(backends.BACKENDS_ENV, 'Xor=missing')
+    with pytest.raises(ValueError):
+        backends.select('Xor', 1)
@@ -1,25 +1,31 @@
 from gf2n import *
 
+# (a, b, a * b) in GF(2^128), also used by bench/bench_gf2n.py
+gf2pow128mul_vectors = [
+    (0xb9623d587488039f1486b2d8d9283453, 0xa06aea0265e84b8a, 0xfead2ebe0998a3da7968b8c2f6dfcbd2),
+    (0x0696ce9a49b10a7c21f61cea2d114a22, 0x8258e63daab974bc, 0x89a493638cea727c0bb06f5e9a0248c7),
+    (0xecf10f64ceff084cd9d9d1349c5d1918, 0xf48a39058af0cf2c, 0x80490c2d2560fe266a5631670c6729c1),
+    (0x9c65a83501fae4d5672e54a3e0612727, 0x9d8bc634f82dfc78, 0xd0c221b4819fdd94e7ac8b0edc0ab2cb),
+    (0xb8885a52910edae3eb16c268e5d3cbc7, 0x98878367a0f4f045, 0xa6f1a7280f1a89436f80fdd5257ec579),
+    (0xd91376456609fac6f85748784c51b272, 0xf6d1fa7f5e2c73b9, 0xbcbb318828da56ce0008616226d25e28),
+    (0x0865625a18a1aace15dba90dedd95d27, 0x395fcb20c3a2a1ff, 0xa1c704fc6e913666c7bd92e3bc2cbca9),
+    (0x45ff1a2274ed22d43d31bb224f519fea, 0xd94a263495856bc5, 0xd0f6ce03966ba1e1face79dfce89e830),
+    (0x0508aaf2fdeaedb36109e8f830ff2140, 0xc15154674dea15bf, 0x67e0dbe4ddff54458fa67af764d467dd),
+    (0xaec8b76366f66dc8e3baaf95020fdfb5, 0xd1552daa9948b824, 0x0a3c509baed65ac69ec36ae7ad03cc24),
+    (0x1c2ff5d21b5555781bbd22426912aa58, 0x5cdda0b2dafbbf2e, 0xc9f85163d006bebfc548d010b6590cf2),
+    (0x1d4db0dfb7b12ea8d431680ac07ba73b, 0xa9913078a5c26c9b, 0x6e71eaf1e7276f893a9e98a377182211),
+    (0xf7d946f08e94d545ce583b409322cdf6, 0x73c174b844435230, 0xad9748630fd502fe9e46f36328d19e8d),
+    (0xdeada9ae22eff9bc3c1669f824c46823, 0x6bdd94753484db33, 0xc40822f2f3984ed58b24bd207b515733),
+    (0x8146e084b094a0814577558be97f9be1, 0xb3fdd171a771c2ef, 0xf0093a3df939fe1922c6a848abfdf474),
+    (0x7c468425a3bda18a842875150b58d753, 0x6358fcb8015c9733, 0x369c44a03648219e2b91f50949efc6b4),
+    (0xe5f445041c8529d28afad3f8e6b76721, 0x06cefb145d7640d1, 0x8c96b0834c896435fe8d4a70c17a8aff),
+]
+
 def test_things():
 
     assert gf2n_mul(0x53, 0xca, 0x11b) == 1
-    assert gf2pow128mul(0xb9623d587488039f1486b2d8d9283453, 0xa06aea0265e84b8a) == 0xfead2ebe0998a3da7968b8c2f6dfcbd2
-    assert gf2pow128mul(0x0696ce9a49b10a7c21f61cea2d114a22, 0x8258e63daab974bc) == 0x89a493638cea727c0bb06f5e9a0248c7
-    assert gf2pow128mul(0xecf10f64ceff084cd9d9d1349c5d1918, 0xf48a39058af0cf2c) == 0x80490c2d2560fe266a5631670c6729c1
-    assert gf2pow128mul(0x9c65a83501fae4d5672e54a3e0612727, 0x9d8bc634f82dfc78) == 0xd0c221b4819fdd94e7ac8b0edc0ab2cb
-    assert gf2pow128mul(0xb8885a52910edae3eb16c268e5d3cbc7, 0x98878367a0f4f045) == 0xa6f1a7280f1a89436f80fdd5257ec579
-    assert gf2pow128mul(0xd91376456609fac6f85748784c51b272, 0xf6d1fa7f5e2c73b9) == 0xbcbb318828da56ce0008616226d25e28
-    assert gf2pow128mul(0x0865625a18a1aace15dba90dedd95d27, 0x395fcb20c3a2a1ff) == 0xa1c704fc6e913666c7bd92e3bc2cbca9
-    assert gf2pow128mul(0x45ff1a2274ed22d43d31bb224f519fea, 0xd94a263495856bc5) == 0xd0f6ce03966ba1e1face79dfce89e830
-    assert gf2pow128mul(0x0508aaf2fdeaedb36109e8f830ff2140, 0xc15154674dea15bf) == 0x67e0dbe4ddff54458fa67af764d467dd
-    assert gf2pow128mul(0xaec8b76366f66dc8e3baaf95020fdfb5, 0xd1552daa9948b824) == 0x0a3c509baed65ac69ec36ae7ad03cc24
-    assert gf2pow128mul(0x1c2ff5d21b5555781bbd22426912aa58, 0x5cdda0b2dafbbf2e) == 0xc9f85163d006bebfc548d010b6590cf2
-    assert gf2pow128mul(0x1d4db0dfb7b12ea8d431680ac07ba73b, 0xa9913078a5c26c9b) == 0x6e71eaf1e7276f893a9e98a377182211
-    assert gf2pow128mul(0xf7d946f08e94d545ce583b409322cdf6, 0x73c174b844435230) == 0xad9748630fd502fe9e46f36328d19e8d
-    assert gf2pow128mul(0xdeada9ae22eff9bc3c1669f824c46823, 0x6bdd94753484db33) == 0xc40822f2f3984ed58b24bd207b515733
-    assert gf2pow128mul(0x8146e084b094a0814577558be97f9be1, 0xb3fdd171a771c2ef) == 0xf0093a3df939fe1922c6a848abfdf474
-    assert gf2pow128mul(0x7c468425a3bda18a842875150b58d753, 0x6358fcb8015c9733) == 0x369c44a03648219e2b91f50949efc6b4
-    assert gf2pow128mul(0xe5f445041c8529d28afad3f8e6b76721, 0x06cefb145d7640d1) == 0x8c96b0834c896435fe8d4a70c17a8aff
+    for a, b, expected in gf2pow128mul_vectors:
+        assert gf2pow128mul(a, b) == expected
 
     assert gf2n_mul(0x00, 0x00, 0x11b) == 0  # Multiplying zero by zero
     assert gf2n_mul(0x00, 0xca, 0x11b) == 0  # Multiplying zero by a non-zero
@@ -90,4 +96,104 @@ def test_things():
         a = random.getrandbits(128)
         b = random.getrandbits(128)
         assert gf2pow128mul(a, b) == gf2pow128mul(b, a)  # Commutativity
-        assert gf2n_add(a, b) == gf2n_sub(a, b)          # XOR-based add/sub are same
\ No newline at end of file
+        assert gf2n_add(a, b) == gf2n_sub(a, b)          # XOR-based add/sub are same
+
+def test_GF128Multiplier():
+    import random
+    random.seed(1)
+    for _ in range(10):
+        h = random.getrandbits(128)
+        mul = GF128Multiplier(h)
+        for x in (0, 1, 2, 0xff, 0x100, 33, random.getrandbits(32), random.getrandbits(128), (1 << 128) - 1):
+            assert mul.mul(x) == gf2pow128mul(h, x)
+    assert GF128Multiplier(0xb9623d587488039f1486b2d8d9283453).mul(0xa06aea0265e84b8a) == 0xfead2ebe0998a3da7968b8c2f6dfcbd2
+
+
+def test_gf2pow128mul_many(monkeypatch):
+    import pytest
+    import gf2n
+    import random
+    random.seed(2)
+    a = 0xb9623d587488039f1486b2d8d9283453
+    values = [b for _, b, _ in gf2pow128mul_vectors] + [0, 1, random.getrandbits(128), (1 << 128) - 1]
+    expected = [gf2pow128mul(a, b) for b in values]
+    assert gf2pow128mul_many(a, values) == expected
+    assert gf2pow128mul_many(a, []) == []
+    # the same products through the GF128Multiplier tables
+    monkeypatch.setattr(gf2n, 'gf2pow128mul_many_min_values', 1)
+    assert gf2pow128mul_many(a, values) == expected
+
+    numpy = pytest.importorskip('numpy')
+    mul = GF128Multiplier(a)
+    words = numpy.array([(b >> 64, b & 0xffffffffffffffff) for b in values], dtype=numpy.uint64)
+    assert [(int(hi) << 64) | int(lo) for hi, lo in gf2pow128mul_many(a, words)] == expected
+    monkeypatch.setattr(gf2n, 'gf2pow128mul_many_min_values', 128)
+    assert [(int(hi) << 64) | int(lo) for hi, lo in gf2pow128mul_many(a, words)] == expected
+    assert gf2pow128mul_many(a, numpy.array([3], dtype=numpy.uint64)).tolist() == [list(divmod(gf2pow128mul(a, 3), 1 << 64))]
+    small = [b for b in values if b < (1 << 64)]
+    assert [(int(hi) << 64) | int(lo) for hi, lo in mul.mul_array(numpy.array(small, dtype=numpy.uint64))] == mul.mul_many(small)
+
+
+def test_gf2pow128mul_matches_gf2n_mul():
+    import random
+    random.seed(3)
+    for _ in range(50):
+        a = random.getrandbits(random.randint(1, 128))
+        b = random.getrandbits(128)
+        assert gf2pow128mul(a, b) == gf2n_mul(a, b, mod128)
+    assert gf2pow128reduce(1 << 128) == 0x87
+    assert gf2pow128reduce(((1 << 128) - 1) * 2) == gf2n_mul((1 << 128) - 1, 2, mod128)
+
+
+def test_clmul_spread():
+    import random
+    random.seed(4)
+
+    def clmul_loop(a, b):
+        res = 0
+        for i in range(a.bit_length()):
+            if (a >> i) & 1:
+                res ^= b << i
+        return res
+
+    assert clmul_spread(0, 0x53) == clmul_spread(0x53, 0) == 0
+    assert clmul_spread(0x53, 0xca) == clmul_loop(0x53, 0xca)
+    # 300 bit operands go through the 16 bit slot variant
+    for bits in (1, 7, 8, 64, 128, 255, 256, 300):
+        a = random.getrandbits(bits) | (1 << (bits - 1))
+        b = random.getrandbits(128) | 1
+        assert clmul_spread(a, b) == clmul_loop(a, b)
+    a = (1 << 300) - 1  # every coefficient at its maximum count
+    assert clmul_spread(a, a) == clmul_loop(a, a)
+
+
+def test_GF2nField():
+    import pytest
+    aes = GF2nField(0x11b)
+    assert aes.generator == 0x03
+    assert GF2nField(0x11b).exp is aes.exp  # tables are built once per modulus
+    assert aes.mul(0x53, 0xca) == 1
+    assert aes.mul(0x57, 0x13) == 0xfe
+    assert aes.inverse(0x53) == 0xca
+    assert aes.div(0xfe, 0x13) == 0x57
+    assert aes.power(0x53, 0) == 1
+    assert aes.power(0, 0) == 1
+    assert aes.power(0, 5) == 0
+    assert aes.power(0x53, -1) == 0xca
+    for a in range(256):
+        for b in range(0, 256, 7):
+            assert aes.mul(a, b) == gf2n_mul(a, b, 0x11b)
+        if a:
+            assert aes.mul(a, aes.inverse(a)) == 1
+            assert aes.power(a, 3) == gf2n_mul(a, gf2n_mul(a, a, 0x11b), 0x11b)
+    with pytest.raises(ZeroDivisionError):
+        aes.inverse(0)
+
+    gf16 = GF2nField(0x1002b)  # x^16+x^5+x^3+x+1
+    for a, b in [(0x1234, 0xfedc), (0xffff, 0xffff), (1, 0x8000)]:
+        assert gf16.mul(a, b) == gf2n_mul(a, b, 0x1002b)
+
+    with pytest.raises(ValueError):
+        GF2nField(0x100)  # x^8, not irreducible
+    with pytest.raises(ValueError):
+        GF2nField(mod128)  # too large for tables
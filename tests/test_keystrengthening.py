@@ -17,4 +17,65 @@ def test_things():
     assert HMAC_WHIRLPOOL(b"\x00\x11\x22\x33\x44\x55\x66\x77\x88\x99\xAA\xBB\xCC\xDD\xEE\xFF\x01\x23\x45\x67\x89\xAB\xCD\xEF\x00\x11\x22\x33\x44\x55\x66\x77\x88\x99\xAA\xBB\xCC\xDD\xEE\xFF\x01\x23\x45\x67\x89\xAB\xCD\xEF\x00\x11\x22\x33\x44\x55\x66\x77\x88\x99\xAA\xBB\xCC\xDD\xEE\xFF", b"abcdbcdecdefdefgefghfghighijhijkijkljklmklmnlmnomnopnopq") == b"\x03\x91\xd2\x80\x00\xb6\x62\xbb\xb8\xe6\x23\x3e\xe8\x6c\xf2\xb2\x84\x74\x4c\x73\x8b\x58\x00\xba\x28\x12\xed\x52\x6f\xe3\x15\x3a\xb1\xba\xe7\xe2\x36\xbe\x96\x54\x49\x3f\x19\xfa\xce\xa6\x44\x1f\x60\xf5\xf0\x18\x93\x09\x11\xa5\xe5\xce\xd8\xf2\x6a\xbf\xa4\x02"
     assert PBKDF2(HMAC_SHA1, b"password", b"\x12\x34\x56\x78", 5, 4) == b'\x5c\x75\xce\xf0'
     assert PBKDF2(HMAC_RIPEMD160, b"password", b"\x12\x34\x56\x78", 5, 4) == b'\x7a\x3d\x7c\x03'
-    assert PBKDF2(HMAC_WHIRLPOOL, b"password", b"\x12\x34\x56\x78", 5, 4) == b'\x50\x7c\x36\x6f'
\ No newline at end of file
+    assert PBKDF2(HMAC_WHIRLPOOL, b"password", b"\x12\x34\x56\x78", 5, 4) == b'\x50\x7c\x36\x6f'
+
+
+def test_HMACKey():
+    class Uncopyable:
+        # a hash object without copy(), like some third party hashes
+        def __init__(self, data=None):
+            self.hash = HASH_SHA1(data)
+        def update(self, data):
+            self.hash.update(data)
+        def digest(self):
+            return self.hash.digest()
+    for hash_func in (HASH_SHA1, Uncopyable):
+        hmac = HMACKey(hash_func, 64, b'Jefe')
+        assert hmac.copyable is (hash_func is HASH_SHA1)
+        for _ in range(2):
+            assert hmac.digest(b"what do ya want for nothing?") == b"\xef\xfc\xdf\x6a\xe5\xeb\x2f\xa2\xd2\x74\x16\xd5\xf1\x84\xdf\x9c\x25\x9a\x7c\x79"
+    for hmacfunc, (hash_func, blocksize) in HMAC_HASHES.items():
+        assert HMACKey(hash_func, blocksize, b'key').digest(b'message') == hmacfunc(b'key', b'message')
+
+def test_PBKDF2_hashlib():
+    import keystrengthening
+    assert HMAC_SHA1 in keystrengthening.PBKDF2_HASHLIB
+    for hmacfunc in HMAC_HASHES:
+        assert PBKDF2(hmacfunc, b"password", b"salt" * 16, 20, 128) == PBKDF2_python(hmacfunc, b"password", b"salt" * 16, 20, 128)
+    # a hashlib name that does not exist is not used
+    assert not keystrengthening._hashlib_pbkdf2_matches(HMAC_SHA1, 'no-such-hash')
+    assert not keystrengthening._hashlib_pbkdf2_matches(HMAC_SHA1, 'sha256')
+
+def test_PBKDF2_executor():
+    from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=2) as threads, ProcessPoolExecutor(max_workers=2) as processes:
+        for hmacfunc in HMAC_HASHES:
+            expected = PBKDF2_python(hmacfunc, b"password", b"salt" * 16, 20, 128)
+            assert PBKDF2_python(hmacfunc, b"password", b"salt" * 16, 20, 128, threads) == expected
+            assert PBKDF2_python(hmacfunc, b"password", b"salt" * 16, 20, 128, processes) == expected
+            assert PBKDF2(hmacfunc, b"password", b"salt" * 16, 20, 128, processes) == expected
+        assert PBKDF2(HMAC_WHIRLPOOL, b"password", b"\x12\x34\x56\x78", 5, 4, processes) == b'\x50\x7c\x36\x6f'
+
+def test_PBKDF2Keypool():
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        for hmacfunc in HMAC_HASHES:
+            expected = PBKDF2_python(hmacfunc, b"password", b"salt" * 16, 20, 128)
+            # with an executor the whole output is derived in one batch
+            keypool = PBKDF2Keypool(hmacfunc, b"password", b"salt" * 16, 20, 128, executor)
+            assert keypool[0:16] == expected[0:16]
+            assert len(keypool.blocks) == -(-128 // keypool.hLen)
+            assert bytes(keypool) == expected
+            keypool = PBKDF2Keypool(hmacfunc, b"password", b"salt" * 16, 20, 128)
+            assert keypool[0:16] == expected[0:16]
+            assert (keypool.password is None) == (hmacfunc in PBKDF2_HASHLIB)
+            if hmacfunc in PBKDF2_HASHLIB:
+                assert len(keypool.blocks) == -(-128 // keypool.hLen)
+            else:
+                assert sorted(keypool.blocks) == [1]
+                assert keypool[32:64] == expected[32:64]
+                assert max(keypool.blocks) == 63 // keypool.hLen + 1
+            assert keypool[100:] == expected[100:]
+            assert keypool[5:5] == b''
+            assert bytes(keypool) == expected
+            assert keypool.password is None
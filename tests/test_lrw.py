@@ -1,3 +1,5 @@
+import pytest
+import lrw
 from lrw import *
 
 def test_LRWMany():
@@ -24,3 +26,63 @@ def test_LRW():
     # assert a known computation from the python2.7 code
     # both values are over 16 bytes to test that facet
     assert xorstring16(b'something you want to do', b'something different that you want') == b'\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x1d\x06\x13F\x12\x13'
+
+def test_LRWTweaks():
+    test_lrwkey = b'meat  run  state'
+    K2 = str2int(test_lrwkey)
+    # cover runs of trailing one bits and a carry into a new byte
+    for start, count in [(1, 32), (33, 32), (0, 3), (250, 20), ((1 << 40) - 5, 10)]:
+        assert list(LRWTweaks(test_lrwkey, start, count)) == [gf2pow128mul(K2, n) for n in range(start, start + count)]
+    assert list(LRWTweaks(test_lrwkey, 7, 0)) == []
+
+def test_LRWSector():
+    from Crypto.Cipher import AES
+    from serpent import Serpent
+    test_key = b'this is a test key with 32 bytes'
+    test_lrwkey = b'meat  run  state'
+    test_cleartext = bytes(range(256)) * 2
+    for cipher in (AES.new(test_key, AES.MODE_ECB), Serpent(test_key)):
+        ciphertext = LRWSector(cipher.encrypt, test_lrwkey, 33, test_cleartext)
+        assert ciphertext == LRWMany(cipher.encrypt, test_lrwkey, 33, test_cleartext)
+        assert LRWSector(cipher.decrypt, test_lrwkey, 33, ciphertext) == test_cleartext
+
+def test_LRWTweakStream():
+    test_lrwkey = b'meat  run  state'
+    for start, count in [(1, 32), (33, 32), (0, 1), (7, 1), (250, 20), (31, 64), (4097, 2048), ((1 << 40) - 5, 10)]:
+        expected = b''.join(K2i.to_bytes(16, 'big') for K2i in LRWTweaks(test_lrwkey, start, count))
+        assert LRWTweakStream(test_lrwkey, start, count).to_bytes(16 * count, 'big') == expected
+    assert LRWTweakStream(test_lrwkey, 1, 0) == 0
+
+def test_LRW_numpy(monkeypatch):
+    pytest.importorskip('numpy')
+    from twofish import Twofish
+    test_cipher = Twofish(b'this is a test key with 32 bytes')
+    test_lrwkey = b'meat  run  state'
+    test_cleartext = bytes(range(256)) * 8
+    for start, count in [(1, 64), (33, 100), (31, 64), (4097, 2048)]:
+        expected = LRWTweakStream(test_lrwkey, start, count).to_bytes(16 * count, 'big')
+        assert LRWTweakArray(test_lrwkey, start, count).tobytes() == expected
+    with_numpy = LRWMany(test_cipher.encrypt, test_lrwkey, 33, test_cleartext)
+    monkeypatch.setattr(lrw, 'numpy', None)
+    assert with_numpy == LRWMany(test_cipher.encrypt, test_lrwkey, 33, test_cleartext)
+
+def test_LRWContext():
+    from serpent import Serpent
+    test_cipher = Serpent(b'this is a test key with 32 bytes')
+    test_lrwkey = b'meat  run  state'
+    test_cleartext = bytes(range(256)) * 8
+    ctx = LRWContext(test_cipher, test_lrwkey)
+    # the context's tables are its own, not the shared ones
+    assert ctx.tables is not lrw_tweak_tables(test_lrwkey)
+    assert ctx.tables.stream(5, 40) == lrw_tweak_tables(test_lrwkey).stream(5, 40)
+    for index, data in [(1, test_cleartext[:32]), (33, test_cleartext)]:
+        ciphertext = ctx.encrypt_blocks(index, data)
+        assert ciphertext == LRWMany(test_cipher.encrypt, test_lrwkey, index, data)
+        assert ctx.decrypt_blocks(index, ciphertext) == data
+        buf = bytearray(data)
+        ctx.encrypt_blocks_into(index, buf, buf)
+        assert buf == ciphertext
+        ctx.decrypt_blocks_into(index, memoryview(buf), ciphertext)
+        assert buf == data
+    with pytest.raises(AssertionError):
+        LRWContext(test_cipher, test_lrwkey[:15])
@@ -1,7 +1,48 @@
+import os
+import pytest
+import serpent
 from serpent import Serpent
 
 def test_serpent():
     __testkey = b'\x00\x01\x02\x03\x04\x05\x06\x07\x08\x09\x0a\x0b\x0c\x0d\x0e\x0f\x10\x11\x12\x13\x14\x15\x16\x17\x18\x19\x1a\x1b\x1c\x1d\x1e\x1f'
     __testdat = b'\x00\x01\x02\x03\x04\x05\x06\x07\x08\t\n\x0b\x0c\r\x0e\x0f'
     assert b'\xde&\x9f\xf83\xe42\xb8[.\x88\xd2p\x1c\xe7\\' == Serpent(__testkey).encrypt(__testdat)
-    assert __testdat == Serpent(__testkey).decrypt(b'\xde&\x9f\xf83\xe42\xb8[.\x88\xd2p\x1c\xe7\\')
\ No newline at end of file
+    assert __testdat == Serpent(__testkey).decrypt(b'\xde&\x9f\xf83\xe42\xb8[.\x88\xd2p\x1c\xe7\\')
+
+def test_serpent_lanes():
+    __testkey = b'\x00\x01\x02\x03\x04\x05\x06\x07\x08\x09\x0a\x0b\x0c\x0d\x0e\x0f\x10\x11\x12\x13\x14\x15\x16\x17\x18\x19\x1a\x1b\x1c\x1d\x1e\x1f'
+    cipher = Serpent(__testkey)
+    assert serpent.lanes_available()
+    for num_blocks in (2, 3, 32, serpent.LANES_MAX_BLOCKS + 5):
+        plaintext = os.urandom(16 * num_blocks)
+        ciphertext = cipher.encrypt(plaintext)
+        # block by block through the one block engine
+        assert ciphertext == b''.join(cipher.encrypt(plaintext[i:i + 16]) for i in range(0, len(plaintext), 16))
+        assert cipher.decrypt(ciphertext) == plaintext
+    assert cipher.encrypt(b'\x00\x01\x02\x03\x04\x05\x06\x07\x08\t\n\x0b\x0c\r\x0e\x0f' * 2) == b'\xde&\x9f\xf83\xe42\xb8[.\x88\xd2p\x1c\xe7\\' * 2
+
+
+def test_serpent_numpy(monkeypatch):
+    pytest.importorskip('numpy')
+    __testkey = b'\x00\x01\x02\x03\x04\x05\x06\x07\x08\x09\x0a\x0b\x0c\x0d\x0e\x0f\x10\x11\x12\x13\x14\x15\x16\x17\x18\x19\x1a\x1b\x1c\x1d\x1e\x1f'
+    cipher = Serpent(__testkey)
+    assert serpent.numpy_available()
+    plaintext = os.urandom(16 * (serpent.NUMPY_MAX_BLOCKS + 3))
+    assert serpent.crypt_numpy(serpent.encrypt, cipher.key_context, plaintext[:32]) == serpent.crypt_lanes(serpent.encrypt, cipher.key_context, plaintext[:32])
+    ciphertext = cipher.encrypt(plaintext)
+    assert cipher.decrypt(ciphertext) == plaintext
+    monkeypatch.setenv('PYTRUECRYPT_BACKENDS', 'Serpent=lanes')
+    assert cipher.encrypt(plaintext) == ciphertext
+
+
+def test_serpent_specialize():
+    __testkey = b'\x00\x01\x02\x03\x04\x05\x06\x07\x08\x09\x0a\x0b\x0c\x0d\x0e\x0f\x10\x11\x12\x13\x14\x15\x16\x17\x18\x19\x1a\x1b\x1c\x1d\x1e\x1f'
+    __testdat = b'\x00\x01\x02\x03\x04\x05\x06\x07\x08\t\n\x0b\x0c\r\x0e\x0f'
+    assert serpent.keyed_available()
+    cipher = Serpent(__testkey, specialize=True)
+    assert cipher.encrypt_block is not serpent.encrypt
+    assert b'\xde&\x9f\xf83\xe42\xb8[.\x88\xd2p\x1c\xe7\\' == cipher.encrypt(__testdat)
+    assert __testdat == cipher.decrypt(b'\xde&\x9f\xf83\xe42\xb8[.\x88\xd2p\x1c\xe7\\')
+    # the compiled functions belong to the instance, nothing caches them by key
+    assert Serpent(__testkey, specialize=True).decrypt_block is not cipher.decrypt_block
+    assert Serpent(__testkey).decrypt_block is serpent.decrypt
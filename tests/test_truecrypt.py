@@ -31,10 +31,16 @@ def twofish_whirlpool_hidden_container():
 def test_rijndael_sha1_container(rijndael_sha1_container):
     tc = truecrypt.TrueCryptVolume(rijndael_sha1_container, tc_pw, truecrypt.Log)
     assert True is truecrypt.TCIsValidVolumeHeader(tc.decrypted_header)
+    rijndael_sha1_container.seek(0)
+    salt = rijndael_sha1_container.read(64)
+    assert tc.info_headerkey == truecrypt.PBKDF2(truecrypt.HMAC_SHA1, tc_pw, salt, 2000, 128)[32:64].hex()
 
 def test_rijndael_twofish_serpent_sha1_container(rijndael_twofish_serpent_sha1_container):
     tc = truecrypt.TrueCryptVolume(rijndael_twofish_serpent_sha1_container, tc_pw, truecrypt.Log)
     assert True is truecrypt.TCIsValidVolumeHeader(tc.decrypted_header)
+    rijndael_twofish_serpent_sha1_container.seek(0)
+    salt = rijndael_twofish_serpent_sha1_container.read(64)
+    assert tc.info_headerkey == truecrypt.PBKDF2(truecrypt.HMAC_SHA1, tc_pw, salt, 2000, 128)[32:128].hex()
 
 def test_serpent_ripemd160_container(serpent_ripemd160_container):
     tc = truecrypt.TrueCryptVolume(serpent_ripemd160_container, tc_pw, truecrypt.Log)
@@ -43,6 +49,27 @@ def test_serpent_ripemd160_container(serpent_ripemd160_container):
 def test_twofish_whirlpool_container(twofish_whirlpool_container):
     tc = truecrypt.TrueCryptVolume(twofish_whirlpool_container, tc_pw, truecrypt.Log)
     assert True is truecrypt.TCIsValidVolumeHeader(tc.decrypted_header)
+    twofish_whirlpool_container.seek(0)
+    salt = twofish_whirlpool_container.read(64)
+    assert tc.info_headerkey == truecrypt.PBKDF2(truecrypt.HMAC_WHIRLPOOL, tc_pw, salt, 1000, 128)[32:64].hex()
+    # the header keypool is not kept
+    assert not hasattr(tc, 'header_keypool')
+
+def test_single_cipher_derived_blocks(monkeypatch, twofish_whirlpool_container, serpent_ripemd160_container):
+    import keystrengthening
+    derived = []
+    def PBKDF2_block(hmacfunc, password, salt, iterations, i):
+        derived.append((hmacfunc, i))
+        return block(hmacfunc, password, salt, iterations, i)
+    block = keystrengthening.PBKDF2_block
+    monkeypatch.setattr(keystrengthening, 'PBKDF2_block', PBKDF2_block)
+    # a single cipher open derives only the blocks of the LRW key and key 1
+    truecrypt.TrueCryptVolume(twofish_whirlpool_container, tc_pw)
+    assert [i for hmacfunc, i in derived if hmacfunc is truecrypt.HMAC_WHIRLPOOL] == [1]
+    derived.clear()
+    monkeypatch.setattr(keystrengthening, 'PBKDF2_HASHLIB', {})
+    truecrypt.TrueCryptVolume(serpent_ripemd160_container, tc_pw)
+    assert [i for hmacfunc, i in derived if hmacfunc is truecrypt.HMAC_RIPEMD160] == [1, 2, 3, 4]
 
 def test_twofish_whirlpool_hidden_container_outer(twofish_whirlpool_hidden_container):
     tc = truecrypt.TrueCryptVolume(twofish_whirlpool_hidden_container, 'outer'.encode(), truecrypt.Log)
@@ -52,4 +79,131 @@ def test_twofish_whirlpool_hidden_container_inner(twofish_whirlpool_hidden_conta
     tc = truecrypt.TrueCryptVolume(twofish_whirlpool_hidden_container, 'inner'.encode(), truecrypt.Log)
     assert True is truecrypt.TCIsValidVolumeHeader(tc.decrypted_header)
 
-# TODO add a test case to test exception/unhappy paths including not able to seek when testing hidden containers
\ No newline at end of file
+# TODO add a test case to test exception/unhappy paths including not able to seek when testing hidden containers
+def test_TCReadSectors(rijndael_sha1_container, twofish_whirlpool_hidden_container):
+    for fileobj, password in [(rijndael_sha1_container, tc_pw), (twofish_whirlpool_hidden_container, 'inner'.encode())]:
+        tc = truecrypt.TrueCryptVolume(fileobj, password)
+        num_sectors = truecrypt.TCSectorCount(tc)
+        sectors = b''.join(truecrypt.TCReadSector(tc, i) for i in range(1, num_sectors + 1))
+        assert len(sectors) == num_sectors * truecrypt.TC_SECTOR_SIZE
+        assert truecrypt.TCReadSectors(tc, 1, num_sectors) == sectors
+        # runs past the end of the volume are cut short
+        assert truecrypt.TCReadSectors(tc, num_sectors - 1, 10) == sectors[-2 * truecrypt.TC_SECTOR_SIZE:]
+        assert truecrypt.TCReadSectors(tc, num_sectors + 1, 1) == b''
+
+def test_TCReadBytes(rijndael_sha1_container, twofish_whirlpool_hidden_container):
+    for fileobj, password in [(rijndael_sha1_container, tc_pw), (twofish_whirlpool_hidden_container, 'inner'.encode())]:
+        tc = truecrypt.TrueCryptVolume(fileobj, password)
+        num_sectors = truecrypt.TCSectorCount(tc)
+        volume = truecrypt.TCReadSectors(tc, 1, num_sectors)
+        for offset, size in [(0, 4), (3, 4), (14, 4), (510, 4), (512, 512), (1000, 3000), (len(volume) - 4, 4)]:
+            assert truecrypt.TCReadBytes(tc, offset, size) == volume[offset:offset + size]
+        # reads past the end of the volume are cut short
+        assert truecrypt.TCReadBytes(tc, len(volume) - 3, 10) == volume[-3:]
+        assert truecrypt.TCReadBytes(tc, len(volume), 10) == b''
+        assert truecrypt.TCReadBytes(tc, 5, 0) == b''
+
+def test_TCReadSectorsInto(rijndael_twofish_serpent_sha1_container, twofish_whirlpool_hidden_container):
+    for fileobj, password in [(rijndael_twofish_serpent_sha1_container, tc_pw), (twofish_whirlpool_hidden_container, 'inner'.encode())]:
+        tc = truecrypt.TrueCryptVolume(fileobj, password)
+        num_sectors = truecrypt.TCSectorCount(tc)
+        sectors = truecrypt.TCReadSectors(tc, 1, num_sectors)
+        buf = bytearray(len(sectors) + 3 * truecrypt.TC_SECTOR_SIZE)
+        assert truecrypt.TCReadSectorsInto(tc, 1, buf) == len(sectors)
+        assert buf[:len(sectors)] == sectors
+        view = memoryview(buf)[truecrypt.TC_SECTOR_SIZE:3 * truecrypt.TC_SECTOR_SIZE]
+        assert truecrypt.TCReadSectorsInto(tc, 2, view) == len(view)
+        assert view == sectors[truecrypt.TC_SECTOR_SIZE:3 * truecrypt.TC_SECTOR_SIZE]
+        assert truecrypt.TCReadSectorsInto(tc, num_sectors + 1, buf) == 0
+
+def test_Twofish(monkeypatch):
+    import os
+    import twofish
+    key = os.urandom(32)
+    reference = twofish.Twofish(key)
+    plaintext = os.urandom(16 * 40)
+    ciphertext = b''.join(reference.encrypt(plaintext[i:i + 16]) for i in range(0, len(plaintext), 16))
+    for backend in ('ctypes', 'package'):
+        monkeypatch.setenv('PYTRUECRYPT_BACKENDS', f'Twofish={backend}')
+        cipher = truecrypt.Twofish(key)
+        assert cipher.encrypt(plaintext) == ciphertext
+        assert cipher.decrypt(ciphertext) == plaintext
+        buf = bytearray(16 + len(ciphertext))
+        view = memoryview(buf)[16:]
+        cipher.decrypt_into(view, ciphertext)
+        assert view == plaintext
+        cipher.encrypt_into(view, view)
+        assert view == ciphertext
+        with pytest.raises(ValueError):
+            cipher.decrypt(ciphertext[:15])
+
+def test_TCHeaderTrial_set_key():
+    import os
+    keys = [os.urandom(32) for _ in range(3)]
+    trial = truecrypt.TCHeaderTrial(os.urandom(448), os.urandom(16), keys)
+    chain = truecrypt.CipherChain([truecrypt.Serpent, truecrypt.Twofish, truecrypt.Rijndael])
+    trial.set_key(chain)
+    other = truecrypt.CipherChain([truecrypt.Serpent])
+    trial.set_key(other)
+    # the same (cipher, key) pair is expanded once
+    assert other.ciphers[0] is chain.ciphers[0]
+    assert len(trial.schedules) == 3
+    assert other.ciphers[0].encrypt(bytes(16)) == truecrypt.Serpent(keys[0]).encrypt(bytes(16))
+
+def test_TrueCryptVolume_no_cached_keys(serpent_ripemd160_container):
+    import lrw
+    multipliers = lrw._lrw_multiplier.cache_info().currsize
+    tables = lrw._lrw_tweak_tables.cache_info().currsize
+    tc = truecrypt.TrueCryptVolume(serpent_ripemd160_container, tc_pw)
+    # neither the header nor the master LRW key outlives the volume
+    assert lrw._lrw_multiplier.cache_info().currsize == multipliers
+    assert lrw._lrw_tweak_tables.cache_info().currsize == tables
+
+def test_TCHeaderTrial():
+    import os
+    header, lrwkey = os.urandom(448), os.urandom(16)
+    keys = [os.urandom(32) for _ in range(3)]
+    trial = truecrypt.TCHeaderTrial(header, lrwkey, keys)
+    for cascade in truecrypt.Cascades:
+        cipher = truecrypt.CipherChain(cascade)
+        cipher.set_key(keys)
+        assert trial.decrypt(cipher) == truecrypt.LRWContext(cipher, lrwkey).decrypt_blocks(1, header)
+        assert trial.decrypt(cipher, 1) == truecrypt.LRWContext(cipher, lrwkey).decrypt_blocks(1, header[:16])
+    assert len(trial.stages) == 2 * sum(len(cascade) for cascade in truecrypt.Cascades)
+    # cascades ending in the same (cipher, key) share the first decryption stage
+    trial = truecrypt.TCHeaderTrial(header, lrwkey, keys)
+    for cascade in [[truecrypt.Twofish, truecrypt.Rijndael], [truecrypt.Serpent, truecrypt.Rijndael]]:
+        cipher = truecrypt.CipherChain(cascade)
+        cipher.set_key(keys)
+        assert trial.decrypt(cipher) == truecrypt.LRWContext(cipher, lrwkey).decrypt_blocks(1, header)
+    assert len(trial.stages) == 3
+
+def test_TrueCryptVolume_executor(twofish_whirlpool_container):
+    from concurrent.futures import ThreadPoolExecutor
+    class RecordingExecutor(ThreadPoolExecutor):
+        batches = []
+        def map(self, fn, items):
+            self.batches.append(list(items))
+            return super().map(fn, items)
+    with RecordingExecutor(max_workers=2) as executor:
+        tc = truecrypt.TrueCryptVolume(twofish_whirlpool_container, tc_pw, executor=executor)
+    assert True is truecrypt.TCIsValidVolumeHeader(tc.decrypted_header)
+    # both Whirlpool blocks in one batch
+    if truecrypt.HMAC_WHIRLPOOL not in truecrypt.PBKDF2_HASHLIB:
+        assert [1, 2] in executor.batches
+
+def test_Twofish_static_plan():
+    # without calibration the C library backend is used, it is registered first
+    assert truecrypt.backends.cache_path() is None
+    for num_blocks in (1, 32, 4096):
+        assert truecrypt.backends.select('Twofish', num_blocks).name == 'ctypes'
+
+def test_cmdline_bad_backends(monkeypatch, tmp_path):
+    import sys
+    outfile = str(tmp_path / 'out')
+    for spec in ('Serpent=bogus', 'Serpent'):
+        monkeypatch.setenv('PYTRUECRYPT_BACKENDS', spec)
+        monkeypatch.setattr(sys, 'argv', ['truecrypt.py', './tests/data/test-serpent-ripemd160.tc', tc_pw.decode(), outfile])
+        with pytest.raises(SystemExit) as e:
+            truecrypt.cmdline()
+        assert str(e.value).startswith('PYTRUECRYPT_BACKENDS: ')